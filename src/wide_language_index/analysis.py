@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  analysis.py
+#  wide-language-index
+#
+
+"""
+Per-sample audio health analysis, computed once per sample and cached by
+checksum so that cropping and the samplers don't have to re-derive it.
+"""
+
+import glob
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import path
+from typing import Any, Dict, Optional
+
+import click
+import numpy as np
+import pydub
+
+from . import audio
+
+ANALYSIS_DIR = ".cache/analysis"
+ANALYSIS_VERSION = 2
+
+# statistics are kept per block, so that any window can be checked cheaply
+BLOCK_S = 1
+CHUNK_BLOCKS = 60
+
+SILENCE_DBFS = -50.0
+MIN_LEVEL = 1e-10
+
+Health = Dict[str, Any]
+
+
+@click.command()
+@click.option("--workers", default=None, type=int, help="Number of worker processes")
+@click.option("--language", help="Only analyse the given language.")
+@click.option("--force", is_flag=True, help="Re-analyse samples with cached results.")
+@click.option(
+    "--save-pregain", is_flag=True, help="Record each sample's gain in the index."
+)
+def analyze_samples(
+    workers: Optional[int] = None,
+    language: Optional[str] = None,
+    force: bool = False,
+    save_pregain: bool = False,
+):
+    """
+    Compute channel statistics, silence ratio, levels and clipping for every
+    sample in samples/, caching the results by checksum.
+    """
+    pattern = "samples/{0}/*.mp3".format(language or "*")
+    to_analyze = []
+    for filename in sorted(glob.glob(pattern)):
+        lang, checksum = parse_sample_filename(filename)
+        if lang.startswith("_"):
+            continue
+
+        if force or load_health(lang, checksum) is None:
+            to_analyze.append(filename)
+
+    print(f"Found {len(to_analyze)} samples to analyse")
+
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 4) - 1)
+
+    completed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyze_file, f): f for f in to_analyze}
+        for future in as_completed(futures):
+            filename = futures[future]
+            try:
+                future.result()
+                completed += 1
+                if completed % 10 == 0 or completed == len(to_analyze):
+                    print(f"Progress: {completed}/{len(to_analyze)} samples analysed")
+            except Exception as e:
+                print(f"Error analysing {filename}: {str(e)}")
+
+    if save_pregain:
+        n = save_pregains(language)
+        print(f"{n} records given a new pregain")
+
+
+def parse_sample_filename(filename: str):
+    "Return the (language, checksum) for a file like samples/fra/fra-<md5>.mp3."
+    language = path.basename(path.dirname(filename))
+    checksum = path.splitext(path.basename(filename))[0].split("-")[-1]
+    return language, checksum
+
+
+def analyze_file(mp3_file: str) -> Health:
+    "Decode and analyse a sample file, caching the result."
+    language, checksum = parse_sample_filename(mp3_file)
+    segment = pydub.AudioSegment.from_mp3(mp3_file)
+    health = analyze_segment(segment)
+    health["checksum"] = checksum
+    save_health(language, checksum, health)
+    return health
+
+
+def analyze_segment(segment: pydub.AudioSegment) -> Health:
+    """
+    Compute health statistics over a decoded segment. Work is done in chunks
+    of blocks to keep temporary arrays small on hour-long recordings.
+    """
+    a = audio.pcm_array(segment)
+    n_frames, n_channels = a.shape
+    full_scale = float(2 ** (8 * segment.sample_width - 1))
+    silence_level = full_scale * 10 ** (SILENCE_DBFS / 20)
+    block = max(1, int(segment.frame_rate * BLOCK_S))
+
+    sum_sq = np.zeros(n_channels)
+    peak = np.zeros(n_channels)
+    n_zero = np.zeros(n_channels)
+    n_clipped = 0
+    n_silent = 0
+    zero_ratios = []
+    block_power = []
+
+    for start in range(0, n_frames, CHUNK_BLOCKS * block):
+        chunk = a[start : start + CHUNK_BLOCKS * block]
+        mag = np.abs(chunk.astype(np.float32))
+
+        sum_sq += np.square(mag, dtype=np.float64).sum(axis=0)
+        peak = np.maximum(peak, mag.max(axis=0))
+        n_clipped += int((mag >= full_scale - 1).sum())
+        n_silent += int((mag.max(axis=1) < silence_level).sum())
+
+        zero = chunk == 0
+        n_zero += zero.sum(axis=0)
+        edges = np.arange(0, len(chunk), block)
+        counts = np.add.reduceat(zero, edges, axis=0, dtype=np.int64)
+        sizes = np.diff(np.append(edges, len(chunk)))
+        zero_ratios.append(counts / sizes[:, None])
+
+        sq = np.square(mag / full_scale, dtype=np.float64).mean(axis=1)
+        block_power.append(np.add.reduceat(sq, edges) / sizes)
+
+    n = max(n_frames, 1)
+    channel_rms = np.sqrt(sum_sq / n) / full_scale
+    channel_peak = peak / full_scale
+    per_block = (
+        np.concatenate(zero_ratios) if zero_ratios else np.zeros((0, n_channels))
+    )
+    level = audio.gated_loudness(
+        np.concatenate(block_power) if block_power else np.zeros(0)
+    )
+    peak_dbfs = _dbfs(channel_peak.max())
+    replay_gain = (
+        0.0
+        if level is None
+        else min(
+            audio.TARGET_LOUDNESS_DBFS - level, audio.PEAK_CEILING_DBFS - peak_dbfs
+        )
+    )
+
+    return {
+        "version": ANALYSIS_VERSION,
+        "duration": round(n_frames / segment.frame_rate, 3),
+        "frame_rate": segment.frame_rate,
+        "channels": n_channels,
+        "sample_width": segment.sample_width,
+        "rms_dbfs": _dbfs(math.sqrt((channel_rms**2).mean())),
+        "peak_dbfs": peak_dbfs,
+        "loudness_dbfs": None if level is None else round(level, 2),
+        "replay_gain": round(replay_gain, 2),
+        "silence_ratio": round(n_silent / n, 4),
+        "clipping_rate": round(n_clipped / (n * n_channels), 6),
+        "channel_stats": [
+            {
+                "rms_dbfs": _dbfs(channel_rms[c]),
+                "peak_dbfs": _dbfs(channel_peak[c]),
+                "zero_ratio": round(float(n_zero[c] / n), 4),
+            }
+            for c in range(n_channels)
+        ],
+        "block_s": BLOCK_S,
+        "zero_ratios": per_block.T.round(3).tolist(),
+    }
+
+
+def _dbfs(level: float) -> float:
+    return round(20 * math.log10(max(float(level), MIN_LEVEL)), 2)
+
+
+def is_bad_mono_window(health: Health, offset: float, duration: float) -> bool:
+    "Is there sound on only one channel, judging from cached block statistics?"
+    if health["channels"] != 2:
+        return False
+
+    block_s = health["block_s"]
+    start = int(offset // block_s)
+    end = int(math.ceil((offset + duration) / block_s))
+    return any(
+        np.mean(ratios[start:end]) > audio.BAD_MONO_RATIO
+        for ratios in health["zero_ratios"]
+        if ratios[start:end]
+    )
+
+
+def sample_gain(pregain: Optional[str], health: Optional[Health]) -> Optional[float]:
+    "The per-sample gain in dB, preferring what's recorded in the index."
+    if pregain is not None:
+        return float(pregain)
+
+    if health is not None:
+        return health["replay_gain"]
+
+    return None
+
+
+def save_pregains(language: Optional[str] = None) -> int:
+    "Copy cached per-sample gains into the index records' pregain field."
+    n = 0
+    for f in sorted(glob.glob("index/{0}/*.json".format(language or "*"))):
+        with open(f) as istream:
+            record = json.load(istream)
+
+        health = load_health(record["language"], record["checksum"])
+        if health is None:
+            continue
+
+        pregain = "{0:.2f}".format(health["replay_gain"])
+        if record.get("pregain") == pregain:
+            continue
+
+        record["pregain"] = pregain
+        s = json.dumps(record, indent=2, sort_keys=True, ensure_ascii=False)
+        with open(f, "w") as ostream:
+            ostream.write(s)
+
+        n += 1
+
+    return n
+
+
+def analysis_filename(language: str, checksum: str) -> str:
+    return "{analysis_dir}/{language}/{language}-{checksum}.json".format(
+        analysis_dir=ANALYSIS_DIR,
+        language=language,
+        checksum=checksum,
+    )
+
+
+def load_health(language: str, checksum: str) -> Optional[Health]:
+    "Return the cached analysis for a sample, or None if it needs computing."
+    filename = analysis_filename(language, checksum)
+    if not path.exists(filename):
+        return None
+
+    with open(filename) as istream:
+        health = json.load(istream)
+
+    if health.get("version") != ANALYSIS_VERSION:
+        return None
+
+    return health
+
+
+def health_stamp(language: str, checksum: str) -> Optional[str]:
+    """
+    A cheap stand-in for a sample's cached analysis, which changes whenever
+    it's rewritten, or None if there isn't one.
+    """
+    try:
+        st = os.stat(analysis_filename(language, checksum))
+    except FileNotFoundError:
+        return None
+
+    return "{0}:{1}:{2}".format(ANALYSIS_VERSION, st.st_size, st.st_mtime_ns)
+
+
+def save_health(language: str, checksum: str, health: Health) -> None:
+    filename = analysis_filename(language, checksum)
+    os.makedirs(path.dirname(filename), exist_ok=True)
+
+    # write atomically, since several workers may share the cache
+    tmp_file = filename + ".tmp{0}".format(os.getpid())
+    with open(tmp_file, "w") as ostream:
+        json.dump(health, ostream)
+    os.replace(tmp_file, filename)
+
+
+def sample_health(sample: Dict[str, Any]) -> Health:
+    "Return the analysis for an index record, computing it on a cache miss."
+    health = load_health(sample["language"], sample["checksum"])
+    if health is None:
+        health = analyze_file(
+            "samples/{language}/{language}-{checksum}.mp3".format(**sample)
+        )
+
+    return health
+
+
+if __name__ == "__main__":
+    analyze_samples()
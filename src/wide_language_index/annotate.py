@@ -17,9 +17,18 @@ from datetime import date
 from os import path
 
 import click
-import pydub
 
-from . import audio, ui
+from . import (
+    analysis,
+    audio,
+    mp3scan,
+    pcm_cache,
+    playback,
+    prefetch,
+    reference,
+    segments,
+    ui,
+)
 
 SETS = {
     "global-top-20": set(
@@ -201,6 +210,18 @@ SAMPLE_DIR = "samples"
 INDEX_DIR = "index"
 MAX_PER_SAMPLE = 2
 MAX_PER_LANGUAGE = 4
+MAX_BAD_PER_SAMPLE = 3
+
+GENDERS = ["male", "female", "mixed", "unclear"]
+PROBLEMS = [
+    "noise",
+    "wrong language",
+    "multiple languages",
+    "excess loan words",
+    "language or place reference",
+    "pauses",
+    "volume",
+]
 
 
 @click.command()
@@ -211,39 +232,53 @@ MAX_PER_LANGUAGE = 4
     help="How to pick the next language to annotate ([worst]/greedy)",
 )
 @click.option("--only", help="Only annotate a single language")
-def main(language_set=None, strategy=None, only=None):
+@click.option(
+    "--pcm-cache-mb", type=int, help="Cache decoded audio, up to this size on disk."
+)
+@click.option(
+    "--prefetch",
+    "depth",
+    type=int,
+    default=prefetch.PREFETCH_DEPTH,
+    help="How many clips to prepare ahead of time.",
+)
+def main(
+    language_set=None,
+    strategy=None,
+    only=None,
+    pcm_cache_mb=None,
+    depth=prefetch.PREFETCH_DEPTH,
+):
     """
     Begin an interactive annotation session, where you are played snippets of
     audio in different languages and you have to mark whether or not they are
     representative samples.
     """
-    if only:
-        is_language_included = set([only]).__contains__
-    else:
-        _validate_language_set(language_set)
-        is_language_included = generate_language_filter(language_set)
+    pcm_cache.configure(pcm_cache_mb)
 
-    metadata = load_metadata(is_language_included)
+    metadata = load_metadata(select_languages(language_set, only))
     session = Session()
 
     ui.clear_screen()
     ui.pause("Beginning annotation, press ENTER to hear the first clip...")
 
-    sampler = (
-        GreedySampler(metadata, DEFAULT_DURATION_S, MAX_PER_SAMPLE)
-        if strategy == "greedy"
-        else RandomSampler(metadata, DEFAULT_DURATION_S, MAX_PER_SAMPLE)
-    )
+    sampler = make_sampler(metadata, strategy)
 
-    for segment in sampler:
-        ann, quit = annotate(segment, session.user, metadata)
+    # prepare upcoming clips while the current one is being annotated
+    prefetcher = prefetch.Prefetcher(sampler, prepare_clip, depth=depth)
+
+    for segment in prefetcher:
+        ann, quit = annotate(segment, session.user, metadata, prefetcher.ready)
 
         if ann is not None:
-            save_annotation(segment.sample, ann, metadata)
+            with prefetcher.lock:
+                save_annotation(segment.sample, ann, sampler.state)
             session.annotated += 1
 
         else:
             print("Skipping...")
+            with prefetcher.lock:
+                sampler.state.release(segment)
             session.skipped += 1
 
         print()
@@ -254,6 +289,22 @@ def main(language_set=None, strategy=None, only=None):
     session.summarize()
 
 
+def select_languages(language_set=None, only=None):
+    "A filter for the languages to annotate."
+    if only:
+        return set([only]).__contains__
+
+    _validate_language_set(language_set)
+    return generate_language_filter(language_set)
+
+
+def make_sampler(metadata, strategy=None):
+    if strategy == "greedy":
+        return GreedySampler(metadata, DEFAULT_DURATION_S, MAX_PER_SAMPLE)
+
+    return RandomSampler(metadata, DEFAULT_DURATION_S, MAX_PER_SAMPLE)
+
+
 def _validate_language_set(language_set):
     if language_set is None or language_set.startswith("@"):
         # fine, don't check these cases
@@ -383,12 +434,162 @@ def generate_language_filter(language_set=None):
     return SETS[language_set].__contains__
 
 
+class SamplerState(object):
+    """
+    Annotation counts for every language and sample, along with a queue per
+    language of the samples we'd most like annotated next. Both are updated
+    incrementally as annotations are saved, rather than recounted.
+    """
+
+    def __init__(self, metadata, max_per_sample):
+        self.metadata = metadata
+        self.max_per_sample = max_per_sample
+        self.lang_counts = collections.Counter()
+        self.good = {}
+        self.total = {}
+        self.bad = {}
+        self.queues = {}
+        self.free = collections.defaultdict(dict)
+        # segments handed out but not yet annotated
+        self.pending = collections.Counter()
+        # samples whose MP3 frames failed a scan
+        self.broken = mp3scan.broken_checksums()
+        # the (good, total) each sample was last queued with, so that a
+        # sample is never queued twice for the same counts
+        self.queued = {}
+        # languages that may have segments again, since a sampler gave up
+        self.touched = set()
+
+        for lang, samples in metadata.items():
+            self.lang_counts[lang] = 0
+            for checksum, s in samples.items():
+                annotations = s.get("annotations", ())
+                self.good[checksum] = sum(a["label"] == "good" for a in annotations)
+                self.bad[checksum] = sum(a["label"] == "bad" for a in annotations)
+                self.total[checksum] = len(annotations)
+                self.lang_counts[lang] += self.good[checksum]
+
+            queue = [self.sample_key(c) for c in samples if self.is_candidate(c)]
+            heapq.heapify(queue)
+            self.queues[lang] = queue
+            for key in queue:
+                self.queued[key[-1]] = key[:2]
+
+    def lang_count(self, language):
+        return self.lang_counts[language]
+
+    def sample_key(self, checksum):
+        "Favour samples with fewer annotations."
+        return (
+            self.good[checksum],
+            self.total[checksum],
+            random.random(),  # randomly break ties
+            checksum,
+        )
+
+    def is_candidate(self, checksum):
+        """
+        Skip samples with enough good annotations, 3+ bad annotations, or
+        broken audio.
+        """
+        return (
+            self.good[checksum] + self.pending[checksum] < self.max_per_sample
+            and self.bad[checksum] < MAX_BAD_PER_SAMPLE
+            and checksum not in self.broken
+        )
+
+    def iter_samples(self, language):
+        """
+        Yield the language's samples best first. Entries made stale by a
+        saved annotation are dropped as they reach the front of the queue,
+        and a sample is dropped for good if the caller moves past it.
+        """
+        queue = self.queues.get(language, [])
+        while queue:
+            good, total, _, checksum = queue[0]
+            if (good, total) != (
+                self.good[checksum],
+                self.total[checksum],
+            ) or not self.is_candidate(checksum):
+                self._pop(queue)
+                continue
+
+            yield self.metadata[language][checksum]
+
+            # the caller wanted more, so this sample has nothing left to offer
+            if queue and queue[0][-1] == checksum:
+                self._pop(queue)
+
+    def _push(self, language, checksum):
+        counts = (self.good[checksum], self.total[checksum])
+        if self.queued.get(checksum) != counts:
+            self.queued[checksum] = counts
+            heapq.heappush(self.queues[language], self.sample_key(checksum))
+
+        self.touched.add(language)
+
+    def _pop(self, queue):
+        good, total, _, checksum = heapq.heappop(queue)
+        if self.queued.get(checksum) == (good, total):
+            del self.queued[checksum]
+
+    def free_segments(self, sample, duration):
+        "The sample's unannotated segments of the given duration."
+        by_duration = self.free[sample["checksum"]]
+        if duration not in by_duration:
+            by_duration[duration] = segments.FreeSegments.for_sample(
+                sample, duration, sample_duration(sample)
+            )
+
+        return by_duration[duration]
+
+    def reserve(self, segment):
+        "Take a segment out of circulation before it's been annotated."
+        free = self.free_segments(segment.sample, segment.duration)
+        free.take_range(segment.offset, segment.duration)
+        self.pending[segment.sample["checksum"]] += 1
+
+    def release(self, segment):
+        "Give up on a reserved segment without annotating it."
+        checksum = segment.sample["checksum"]
+        if self.pending[checksum] > 0:
+            self.pending[checksum] -= 1
+
+        if self.is_candidate(checksum):
+            self._push(segment.sample["language"], checksum)
+
+    def record(self, sample, annotation):
+        "Count a newly saved annotation, in O(log n)."
+        lang = sample["language"]
+        checksum = sample["checksum"]
+
+        for free in self.free[checksum].values():
+            free.take_range(annotation["offset"], annotation["duration"])
+
+        if self.pending[checksum] > 0:
+            self.pending[checksum] -= 1
+
+        self.total[checksum] += 1
+        if annotation["label"] == "good":
+            self.good[checksum] += 1
+            self.lang_counts[lang] += 1
+        else:
+            self.bad[checksum] += 1
+
+        if self.is_candidate(checksum):
+            self._push(lang, checksum)
+
+
 class AbstractSampler(object):
     def __init__(self, metadata, duration, max_per_sample):
         self.metadata = metadata
         self.duration = duration
         self.max_per_sample = max_per_sample
+        self.state = SamplerState(metadata, max_per_sample)
         self.queue = self.build_queue()
+        # languages with nothing to offer until a segment is released or saved
+        self.blocked = set()
+        self.last = None
 
     def pop(self):
         return heapq.heappop(self.queue)[-1]
@@ -398,15 +599,43 @@ class AbstractSampler(object):
 
     def __iter__(self):
         while True:
+            segment = self.next_segment()
+            if segment is None:
+                return
+
+            yield segment
+
+    def next_segment(self):
+        """
+        Choose and reserve the next segment, or return None if there's
+        nothing left for now. Languages that ran out come back into the
+        rotation once one of their samples frees up.
+        """
+        if self.last is not None:
+            # requeued only now, so its key reflects any annotation saved since
+            self.push(self.last)
+            self.last = None
+
+        for lang in self.blocked & self.state.touched:
+            self.blocked.discard(lang)
+            self.push(lang)
+        self.state.touched.clear()
+
+        while self.queue:
             lang = self.pop()
             segment = self.find_segment(lang)
 
             if not segment:
                 print("Skipping {}: need more samples".format(lang))
+                self.blocked.add(lang)
                 continue
 
-            yield segment
-            self.push(lang)
+            # reserve it, so that a prefetching caller isn't given it twice
+            self.state.reserve(segment)
+            self.last = lang
+            return segment
+
+        return None
 
     def find_segment(self, l):
         for sample in self.iter_samples(l):
@@ -414,55 +643,14 @@ class AbstractSampler(object):
                 return segment
 
     def iter_samples(self, l):
-        "Favour samples with fewer annotations. Skip samples with 3+ bad annotations."
-        samples = self.metadata[l]
-
-        s_by_annotations = []
-        for s in samples.values():
-            # Count bad annotations
-            bad_count = sum(a["label"] == "bad" for a in s.get("annotations", ()))
-            if bad_count >= 3:
-                continue
-
-            if sample_annotation_count(s) < self.max_per_sample:
-                s_by_annotations.append(
-                    (
-                        sample_annotation_count(s),
-                        sample_annotation_count(s, include_all=True),
-                        random.random(),
-                        s,
-                    )
-                )
-
-        s_by_annotations.sort()
-
-        for _, _, _, s in s_by_annotations:
-            yield s
+        return self.state.iter_samples(l)
 
     def iter_segments(self, sample):
-        "Pick random segments that haven't been annotated yet."
-        sample_len = sample_duration(sample)
-
-        n_segments = int(sample_len / self.duration)
-        segment_ids = list(range(n_segments))
-        random.shuffle(segment_ids)
-
-        seen = set(
-            [
-                a["offset"]
-                for a in sample.get("annotations", ())
-                if int(a["duration"]) == self.duration
-            ]
-        )
-
-        for segment_id in segment_ids:
-            offset = segment_id * self.duration
-
-            # skip if annotated already
-            if offset in seen:
-                continue
-
-            yield Segment(sample, offset, self.duration)
+        "Pick a random segment that hasn't been annotated yet."
+        free = self.state.free_segments(sample, self.duration)
+        segment_id = free.choose()
+        if segment_id is not None:
+            yield Segment(sample, free.offset(segment_id), self.duration)
 
     def build_queue(self):
         queue = [self.gen_key(l) for l in self.metadata.keys()]
@@ -476,7 +664,7 @@ class GreedySampler(AbstractSampler):
     """
 
     def gen_key(self, l):
-        c = lang_annotation_count(l, self.metadata)
+        c = self.state.lang_count(l)
 
         if c < MAX_PER_LANGUAGE:
             # put those with more annotations at the front, and those with enough annotations at
@@ -503,39 +691,26 @@ class RandomSampler(AbstractSampler):
 
     def gen_key(self, l):
         return (
-            lang_annotation_count(l, self.metadata),
+            self.state.lang_count(l),
             random.random(),  # randomly break ties
             l,
         )
 
 
 def sample_duration(sample):
-    filename = sample_filename(sample)
-    audio = pydub.AudioSegment.from_mp3(filename)
-    return audio.duration_seconds
+    return analysis.sample_health(sample)["duration"]
 
 
 def iter_segments(sample, segment_duration):
-    sample_len = sample_duration(sample)
-
-    # generate options
-    unannotated = set()
-    offset = 0
-    while offset + segment_duration < sample_len:
-        unannotated.add((offset, segment_duration))
-        offset += segment_duration
-
-    # eliminate annotated segments
-    for annotation in sample.get("annotations", ()):
-        offset = int(annotation["offset"])
-        duration = int(annotation["duration"])
-        unannotated.remove((offset, duration))
-
-    unannotated = list(unannotated)
-    random.shuffle(unannotated)
+    "Yield every unannotated segment of the sample, in random order."
+    free = segments.FreeSegments.for_sample(
+        sample, segment_duration, sample_duration(sample)
+    )
 
-    for offset, duration in unannotated:
-        yield Segment(sample, offset, duration)
+    while len(free):
+        segment_id = free.choose()
+        free.take(segment_id)
+        yield Segment(sample, free.offset(segment_id), segment_duration)
 
 
 def sample_filename(sample):
@@ -546,12 +721,39 @@ def sample_filename(sample):
     )
 
 
-def save_annotation(sample, annotation, metadata):
+def prepare_clip(segment):
+    "Crop and fix up a segment, ready to play."
+    s = segment
+    health = analysis.sample_health(s.sample)
+    return audio.prepared(
+        audio.load_window(sample_filename(s.sample), s.offset, s.duration),
+        bad_mono=analysis.is_bad_mono_window(health, s.offset, s.duration),
+        gain=analysis.sample_gain(s.sample.get("pregain"), health),
+    )
+
+
+def stream_clip(segment):
+    "Yield a segment's audio in chunks as it's decoded, ready to play."
+    s = segment
+    health = analysis.sample_health(s.sample)
+    return audio.stream_window(
+        sample_filename(s.sample),
+        s.offset,
+        s.duration,
+        health["frame_rate"],
+        health["channels"],
+        bad_mono=analysis.is_bad_mono_window(health, s.offset, s.duration),
+        gain=analysis.sample_gain(s.sample.get("pregain"), health) or 0.0,
+    )
+
+
+def save_annotation(sample, annotation, state):
     lang = sample["language"]
-    c_before = lang_annotation_count(lang, metadata)
+    c_before = state.lang_count(lang)
 
     # add this annotation
     sample.setdefault("annotations", []).append(annotation)
+    state.record(sample, annotation)
 
     metadata_file = metadata_filename(sample)
     s_norm = json.dumps(sample, indent=2, sort_keys=True)
@@ -559,7 +761,7 @@ def save_annotation(sample, annotation, metadata):
         ostream.write(s_norm)
 
     # give a status update for this language
-    c_after = lang_annotation_count(lang, metadata)
+    c_after = state.lang_count(lang)
 
     print("{0}: {1} -> {2}".format(lang, c_before, c_after))
 
@@ -583,20 +785,21 @@ def metadata_filename(sample):
     )
 
 
-def annotate(segment, user, metadata):
-    c = AnnotateCmd(segment, user, metadata)
+def annotate(segment, user, metadata, clips):
+    c = AnnotateCmd(segment, user, metadata, clips)
     c.cmdloop()
     return c.annotation, c.quit_flag
 
 
 class AnnotateCmd(cmd.Cmd):
-    def __init__(self, segment, user, metadata):
+    def __init__(self, segment, user, metadata, clips):
         super(AnnotateCmd, self).__init__()
         self.segment = segment
+        self.clips = clips
         self.user = user
         self.annotation = None
         self.quit_flag = False
-        self.language_names = load_language_names()
+        self.language_names = reference.language_names()
         self.metadata = metadata
 
         listened = self._play()
@@ -616,8 +819,13 @@ class AnnotateCmd(cmd.Cmd):
             )
         )
 
-        with audio.cropped(filename, s.offset, s.duration) as clip:
-            return audio.play_mp3(clip)
+        # usually prepared in the background already, otherwise start playing
+        # while it's still being decoded
+        clip = self.clips(s)
+        if clip is not None:
+            return playback.play_segment(clip)
+
+        return playback.play(stream_clip(s))
 
     def _edit(self):
         annotation = {
@@ -632,10 +840,7 @@ class AnnotateCmd(cmd.Cmd):
             if ok:
                 speakers = ui.input_number("speakers", minimum=0, maximum=10)
                 if speakers > 0:
-                    genders = ui.input_single_option(
-                        "Gender of speakers",
-                        ["male", "female", "mixed", "unclear"],
-                    )
+                    genders = ui.input_single_option("Gender of speakers", GENDERS)
                 else:
                     genders = "unclear"
 
@@ -649,18 +854,7 @@ class AnnotateCmd(cmd.Cmd):
                 )
 
             else:
-                problem = ui.input_single_option(
-                    "Problems with the sample",
-                    [
-                        "noise",
-                        "wrong language",
-                        "multiple languages",
-                        "excess loan words",
-                        "language or place reference",
-                        "pauses",
-                        "volume",
-                    ],
-                )
+                problem = ui.input_single_option("Problems with the sample", PROBLEMS)
                 annotation.update(
                     {
                         "problems": [problem],
@@ -764,11 +958,6 @@ def page(content):
         pass
 
 
-def load_language_names():
-    name_index = json.load(open("ext/name_index_20140320.json"))
-    return {r["id"]: r["print_name"] for r in name_index}
-
-
 if __name__ == "__main__":
     try:
         main()
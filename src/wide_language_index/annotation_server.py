@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+#
+#  annotation_server.py
+#  wide-language-index
+#
+
+"""
+A local HTTP service for annotating with many people at once. Each annotator
+leases a segment from the usual samplers, streams its clip, and posts back
+their annotation, which a single writer thread saves to the index.
+"""
+
+import collections
+import io
+import json
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional
+from urllib.parse import parse_qs, urlparse
+
+import click
+
+from . import annotate, pcm_cache, reference
+
+LEASE_S = 600
+PREPARED_CLIPS = 4
+PREPARE_WORKERS = 4
+
+Lease = collections.namedtuple("Lease", "id segment annotator expires clip")
+
+
+class NoSegmentsLeft(Exception):
+    pass
+
+
+@click.command()
+@click.option("--language-set", help="Only annotate a particular set of langauges.")
+@click.option(
+    "--strategy",
+    default="worst",
+    help="How to pick the next language to annotate ([worst]/greedy)",
+)
+@click.option("--only", help="Only annotate a single language")
+@click.option("--host", default="127.0.0.1", help="Address to listen on.")
+@click.option("--port", type=int, default=8000, help="Port to listen on.")
+@click.option(
+    "--lease-s",
+    type=int,
+    default=LEASE_S,
+    help="Seconds an annotator has before their segment is handed out again.",
+)
+@click.option(
+    "--prepared",
+    type=int,
+    default=PREPARED_CLIPS,
+    help="How many clips to keep ready ahead of requests.",
+)
+@click.option(
+    "--pcm-cache-mb", type=int, help="Cache decoded audio, up to this size on disk."
+)
+def main(
+    language_set=None,
+    strategy=None,
+    only=None,
+    host="127.0.0.1",
+    port=8000,
+    lease_s=LEASE_S,
+    prepared=PREPARED_CLIPS,
+    pcm_cache_mb=None,
+):
+    """
+    Serve annotation over HTTP, so that many people can annotate at once
+    without ever being given the same segment.
+    """
+    pcm_cache.configure(pcm_cache_mb)
+
+    metadata = annotate.load_metadata(annotate.select_languages(language_set, only))
+    sampler = annotate.make_sampler(metadata, strategy)
+    leases = LeaseManager(sampler, lease_s=lease_s, prepared=prepared)
+    writer = AnnotationWriter(sampler.state, leases.sampler_lock)
+
+    server = ThreadingHTTPServer((host, port), AnnotationHandler)
+    server.leases = leases
+    server.writer = writer
+    server.language_names = reference.language_names()
+
+    print("Serving annotation on http://{0}:{1}/".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        leases.close()
+        writer.close()
+
+
+class LeaseManager(object):
+    """
+    Hand out segments from a sampler, each to one annotator at a time. A
+    segment whose lease runs out goes to the next person who asks. Segments
+    are chosen and their clips prepared in the background, a few ahead of
+    demand.
+
+    `lock` covers leases and the ready queue, and is only ever held briefly.
+    Choosing a segment may decode a whole sample, so the sampler and its
+    state have their own `sampler_lock`, which requests never wait on.
+    """
+
+    def __init__(self, sampler, lease_s=LEASE_S, prepared=PREPARED_CLIPS):
+        self.sampler = sampler
+        self.lease_s = lease_s
+        self.n_prepared = prepared
+        self.executor = ThreadPoolExecutor(max_workers=PREPARE_WORKERS)
+        self.lock = threading.Lock()
+        self.sampler_lock = threading.Lock()
+        # notified whenever a segment is readied, or filling stops
+        self.changed = threading.Condition(self.lock)
+        self.leases: Dict[str, Lease] = {}
+        self.ready = collections.deque()
+        self.filling = False
+
+    def lease(self, annotator: str) -> Lease:
+        with self.lock:
+            self.expire()
+            self.top_up()
+            while not self.ready and self.filling:
+                self.changed.wait()
+
+            if not self.ready:
+                raise NoSegmentsLeft()
+
+            segment, clip = self.ready.popleft()
+            lease = Lease(
+                uuid.uuid4().hex,
+                segment,
+                annotator,
+                time.time() + self.lease_s,
+                clip,
+            )
+            self.leases[lease.id] = lease
+            self.top_up()
+
+        return lease
+
+    def get(self, lease_id: str) -> Optional[Lease]:
+        with self.lock:
+            lease = self.leases.get(lease_id)
+
+        if lease is None or lease.expires < time.time():
+            return None
+
+        return lease
+
+    def release(self, lease_id: str) -> Optional[Lease]:
+        "End a lease, returning it if it was still current. Call with the lock."
+        lease = self.leases.pop(lease_id, None)
+        if lease is None or lease.expires < time.time():
+            if lease is not None:
+                self.ready.appendleft((lease.segment, lease.clip))
+            return None
+
+        return lease
+
+    def expire(self) -> None:
+        now = time.time()
+        for lease in list(self.leases.values()):
+            if lease.expires < now:
+                del self.leases[lease.id]
+                self.ready.appendleft((lease.segment, lease.clip))
+
+    def top_up(self) -> None:
+        "Start readying more segments in the background. Call with the lock."
+        if len(self.ready) < self.n_prepared and not self.filling:
+            self.filling = True
+            self.executor.submit(self._fill)
+
+    def _fill(self) -> None:
+        segment = None
+        try:
+            while True:
+                with self.lock:
+                    if segment is not None:
+                        clip = self.executor.submit(clip_wav, segment)
+                        self.ready.append((segment, clip))
+                        self.changed.notify_all()
+
+                    if len(self.ready) >= self.n_prepared:
+                        return
+
+                # the sampler reserves each segment as it hands it out; it
+                # has nothing for now, but may again once leases are saved
+                with self.sampler_lock:
+                    segment = self.sampler.next_segment()
+
+                if segment is None:
+                    return
+        finally:
+            with self.lock:
+                self.filling = False
+                self.changed.notify_all()
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AnnotationWriter(object):
+    """
+    Save annotations one at a time on a background thread, so that record
+    updates never interleave and annotators never wait on the disk.
+    """
+
+    def __init__(self, state, lock):
+        self.state = state
+        self.lock = lock
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, sample: Dict[str, Any], annotation: Dict[str, Any]) -> None:
+        self.queue.put((sample, annotation))
+
+    def run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            sample, annotation = item
+            try:
+                with self.lock:
+                    annotate.save_annotation(sample, annotation, self.state)
+            except Exception as e:
+                print("ERROR saving {0}: {1}".format(sample["checksum"], e))
+
+    def close(self) -> None:
+        "Finish any pending writes."
+        self.queue.put(None)
+        self.thread.join()
+
+
+class AnnotationHandler(BaseHTTPRequestHandler):
+    """
+    GET  /             a minimal annotation page
+    GET  /next?annotator=NAME
+                       lease a segment, returned as JSON
+    GET  /clip/LEASE   the leased segment's audio, as WAV
+    POST /annotation   {"lease": ..., "label": "good"|"bad", ...}
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/":
+            self.send_body(PAGE.encode("utf8"), "text/html; charset=utf-8")
+
+        elif url.path == "/next":
+            annotator = parse_qs(url.query).get("annotator", [""])[0].strip()
+            if not annotator:
+                return self.send_error(HTTPStatus.BAD_REQUEST, "annotator is required")
+
+            try:
+                lease = self.server.leases.lease(annotator)
+            except NoSegmentsLeft:
+                return self.send_json({"done": True})
+
+            s = lease.segment
+            language = s.sample["language"]
+            self.send_json(
+                {
+                    "lease": lease.id,
+                    "language": language,
+                    "language_name": self.server.language_names.get(language),
+                    "checksum": s.sample["checksum"],
+                    "offset": s.offset,
+                    "duration": s.duration,
+                    "clip": "/clip/{0}".format(lease.id),
+                    "expires": lease.expires,
+                }
+            )
+
+        elif url.path.startswith("/clip/"):
+            lease = self.server.leases.get(url.path[len("/clip/") :])
+            if lease is None:
+                return self.send_error(HTTPStatus.NOT_FOUND, "no such lease")
+
+            try:
+                clip = lease.clip.result()
+            except Exception as e:
+                return self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, str(e))
+
+            self.send_body(clip, "audio/wav")
+
+        else:
+            self.send_error(HTTPStatus.NOT_FOUND)
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/annotation":
+            return self.send_error(HTTPStatus.NOT_FOUND)
+
+        try:
+            length = int(self.headers["Content-Length"])
+        except (KeyError, TypeError, ValueError):
+            return self.send_error(HTTPStatus.BAD_REQUEST, "bad Content-Length")
+
+        if length < 0:
+            return self.send_error(HTTPStatus.BAD_REQUEST, "bad Content-Length")
+
+        try:
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self.send_error(HTTPStatus.BAD_REQUEST, "invalid JSON")
+
+        if not isinstance(body, dict) or not isinstance(body.get("lease"), str):
+            return self.send_error(
+                HTTPStatus.BAD_REQUEST, "expected an object with a lease"
+            )
+
+        leases = self.server.leases
+        with leases.lock:
+            lease = leases.leases.get(body.get("lease"))
+            if lease is None:
+                return self.send_error(HTTPStatus.CONFLICT, "lease expired or unknown")
+
+            try:
+                annotation = build_annotation(lease, body)
+            except ValueError as e:
+                return self.send_error(HTTPStatus.BAD_REQUEST, str(e))
+
+            lease = leases.release(lease.id)
+            if lease is None:
+                return self.send_error(HTTPStatus.CONFLICT, "lease expired")
+
+        self.server.writer.put(lease.segment.sample, annotation)
+        self.send_json({"ok": True}, HTTPStatus.ACCEPTED)
+
+    def send_json(self, data, status=HTTPStatus.OK):
+        self.send_body(json.dumps(data).encode("utf8"), "application/json", status)
+
+    def send_body(self, body, content_type, status=HTTPStatus.OK):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def build_annotation(lease: Lease, body: Dict[str, Any]) -> Dict[str, Any]:
+    "Check a posted annotation, and fill it out the same way annotate does."
+    annotation = {
+        "date": str(date.today()),
+        "offset": lease.segment.offset,
+        "duration": lease.segment.duration,
+        "annotator": lease.annotator,
+    }
+
+    label = body.get("label")
+    if label == "good":
+        speakers = body.get("speakers")
+        if not isinstance(speakers, int) or not 0 <= speakers <= 10:
+            raise ValueError("speakers must be a number from 0 to 10")
+
+        genders = body.get("genders", "unclear") if speakers > 0 else "unclear"
+        if genders not in annotate.GENDERS:
+            raise ValueError("genders must be one of " + ", ".join(annotate.GENDERS))
+
+        annotation.update(
+            {"problems": [], "speakers": speakers, "genders": genders, "label": label}
+        )
+
+    elif label == "bad":
+        problem = body.get("problem")
+        if problem not in annotate.PROBLEMS:
+            raise ValueError("problem must be one of " + ", ".join(annotate.PROBLEMS))
+
+        annotation.update({"problems": [problem], "label": label})
+
+    else:
+        raise ValueError("label must be good or bad")
+
+    return annotation
+
+
+def clip_wav(segment) -> bytes:
+    "Prepare a segment's clip as WAV, which any browser can play."
+    buf = io.BytesIO()
+    annotate.prepare_clip(segment).export(buf, format="wav")
+    return buf.getvalue()
+
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>Wide Language Index annotation</title></head>
+<body>
+<p>Annotator: <input id="annotator" placeholder="Name &lt;email&gt;" size="40">
+<button onclick="next()">Next clip</button></p>
+<p id="info"></p>
+<audio id="player" controls></audio>
+<form id="form" onsubmit="submitAnnotation(event)" hidden>
+<p><label><input type="radio" name="label" value="good" checked> good</label>
+speakers <input name="speakers" type="number" min="0" max="10" value="1">
+genders <select name="genders">GENDERS</select></p>
+<p><label><input type="radio" name="label" value="bad"> bad</label>
+problem <select name="problem">PROBLEMS</select></p>
+<button>Save</button>
+</form>
+<script>
+let lease = null;
+const annotator = document.getElementById("annotator");
+annotator.value = localStorage.getItem("annotator") || "";
+
+async function next() {
+  localStorage.setItem("annotator", annotator.value);
+  const r = await fetch("/next?annotator=" + encodeURIComponent(annotator.value));
+  const seg = await r.json();
+  if (seg.done) {
+    document.getElementById("info").textContent = "Nothing left to annotate.";
+    return;
+  }
+  lease = seg.lease;
+  document.getElementById("info").textContent =
+    `${seg.language_name} (${seg.language}) at ${seg.offset}s`;
+  const player = document.getElementById("player");
+  player.src = seg.clip;
+  player.play();
+  document.getElementById("form").hidden = false;
+}
+
+async function submitAnnotation(e) {
+  e.preventDefault();
+  const f = new FormData(e.target);
+  const body = {lease: lease, label: f.get("label")};
+  if (body.label === "good") {
+    body.speakers = parseInt(f.get("speakers"));
+    body.genders = f.get("genders");
+  } else {
+    body.problem = f.get("problem");
+  }
+  const r = await fetch("/annotation", {method: "POST", body: JSON.stringify(body)});
+  if (!r.ok) alert(await r.text());
+  next();
+}
+</script>
+</body>
+</html>
+""".replace(
+    "GENDERS", "".join("<option>{0}</option>".format(g) for g in annotate.GENDERS)
+).replace(
+    "PROBLEMS", "".join("<option>{0}</option>".format(p) for p in annotate.PROBLEMS)
+)
+
+
+if __name__ == "__main__":
+    main()
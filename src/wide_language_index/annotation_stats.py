@@ -17,6 +17,8 @@ from typing import Dict, List, Any, Optional, Iterable
 import click
 import humanize
 
+from . import reference
+
 
 TEMPLATE_PAGE = """# Audio statistics
 
@@ -55,7 +57,7 @@ def annotation_stats(output_file: str) -> None:
     Generate a summary of annotation statistics for each language in Markdown.
     """
     metadata = load_metadata()
-    languages = load_language_names()
+    languages = reference.language_names()
 
     summary = generate_summary(metadata, languages)
     write_summary(summary, output_file)
@@ -72,11 +74,6 @@ def load_metadata() -> LanguageIndex:
     return metadata
 
 
-def load_language_names() -> Dict[str, str]:
-    name_index = json.load(open("ext/name_index_20140320.json"))
-    return {r["id"]: r["print_name"] for r in name_index}
-
-
 def generate_summary(metadata: LanguageIndex, languages: Dict[str, str]) -> str:
     stats = overall_stats(metadata)
     per_language = per_language_stats(metadata, languages)
@@ -9,33 +9,278 @@ Audio manipulation utilities.
 """
 
 import contextlib
+import functools
+import math
+import os
+import subprocess
 import tempfile
+from collections import namedtuple
 
 import numpy as np
 import pydub
-import sh
 from characteristic import Attribute, attributes
-from sh import afplay, mp3gain
+
+from . import pcm_cache, playback
 
 MS_PER_S = 1000
 
+# fraction of silent frames on one channel before we call a clip "bad mono"
+BAD_MONO_RATIO = 0.4
 
-@contextlib.contextmanager
-def cropped(mp3_file, offset, duration, adjust_volume=True):
-    whole_clip = pydub.AudioSegment.from_mp3(mp3_file)
-    selected = whole_clip[offset * MS_PER_S : (offset + duration) * MS_PER_S]
+PCM_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+PCM_FORMATS = {1: "s8", 2: "s16le", 4: "s32le"}
 
-    if is_bad_mono(selected):
-        selected = selected.set_channels(1)
+Profile = namedtuple(
+    "Profile", "name format codec bitrate frame_rate channels extension"
+)
+
+# output profiles for clips; a frame rate or channel count of None keeps
+# whatever the source had
+PROFILES = {
+    p.name: p
+    for p in [
+        Profile("mp3", "mp3", "libmp3lame", "128k", None, None, "mp3"),
+        Profile("mp3-64k", "mp3", "libmp3lame", "64k", 22050, 1, "mp3"),
+        Profile("opus-24k", "ogg", "libopus", "24k", 48000, 1, "opus"),
+        Profile("opus-48k", "ogg", "libopus", "48k", 48000, 2, "opus"),
+        Profile("vorbis-48k", "ogg", "libvorbis", "48k", 44100, 1, "ogg"),
+    ]
+}
+
+# ReplayGain 2.0 reference level; loudness is gated RMS in the style of
+# BS.1770, without the K-weighting filter
+TARGET_LOUDNESS_DBFS = -18.0
+PEAK_CEILING_DBFS = -1.0
+GATE_BLOCK_S = 0.4
+ABSOLUTE_GATE_DBFS = -70.0
+RELATIVE_GATE_DB = -10.0
+
+
+@contextlib.contextmanager
+def cropped(mp3_file, offset, duration, adjust_volume=True, bad_mono=None, gain=None):
+    """
+    Yield a temporary mp3 file containing just the given window of the sample.
+    If the caller already knows whether the window is bad mono (e.g. from
+    cached analysis), pass it in to skip re-deriving it. Likewise a known
+    per-sample gain in dB can be passed in, otherwise the window is measured.
+    """
+    selected = load_window(mp3_file, offset, duration)
+    selected = prepared(
+        selected, adjust_volume=adjust_volume, bad_mono=bad_mono, gain=gain
+    )
 
     with tempfile.NamedTemporaryFile(suffix=".mp3") as t:
         selected.export(t, format="mp3")
+        yield t.name
 
-        # normalize the sample's volume
-        if adjust_volume:
-            mp3gain("-r", "-k", "-t", "-s", "r", t.name)
 
-        yield t.name
+def prepared(selected, adjust_volume=True, bad_mono=None, gain=None):
+    "Fix up a cropped window so that it's ready to encode."
+    if bad_mono is None:
+        bad_mono = is_bad_mono(selected)
+
+    if bad_mono:
+        selected = selected.set_channels(1)
+
+    # normalize the sample's volume before the one and only encode
+    if adjust_volume:
+        selected = normalized(selected, gain=gain)
+
+    return selected
+
+
+def load_window(mp3_file, offset, duration):
+    "Decode just the given window, via the PCM cache if it's enabled."
+    return window_loader(mp3_file)(offset, duration)
+
+
+def stream_window(
+    mp3_file, offset, duration, frame_rate, channels, bad_mono=False, gain=0.0
+):
+    """
+    Yield the given window of the sample in short chunks, fixed up with a
+    known gain, as soon as each is decoded. The sample's frame rate and
+    channel count must be known up front, e.g. from cached analysis.
+    """
+    cache = pcm_cache.default_cache()
+    if cache is not None:
+        chunks = playback.iter_chunks(cache.window(mp3_file, offset, duration))
+    else:
+        chunks = decode_chunks(mp3_file, offset, duration, frame_rate, channels)
+
+    for chunk in chunks:
+        if bad_mono:
+            chunk = chunk.set_channels(1)
+        if gain:
+            chunk = chunk.apply_gain(gain)
+        yield chunk
+
+
+def decode_chunks(
+    mp3_file, offset, duration, frame_rate, channels, chunk_s=playback.CHUNK_S
+):
+    "Decode a window with ffmpeg, yielding 16-bit PCM chunks as they arrive."
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-nostdin",
+        "-ss",
+        str(offset),
+        "-t",
+        str(duration),
+        "-i",
+        mp3_file,
+        "-f",
+        PCM_FORMATS[2],
+        "-ar",
+        str(frame_rate),
+        "-ac",
+        str(channels),
+        "pipe:1",
+    ]
+    chunk_bytes = int(chunk_s * frame_rate) * channels * 2
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            data = p.stdout.read(chunk_bytes)
+            if not data:
+                break
+
+            yield pydub.AudioSegment(
+                data=data, sample_width=2, frame_rate=frame_rate, channels=channels
+            )
+    finally:
+        p.stdout.close()
+        p.kill()
+        p.wait()
+
+
+def window_loader(mp3_file):
+    """
+    Return a function that cuts windows from the sample, decoding it at most
+    once however many windows are taken.
+    """
+    # decode or map the sample now, so that callers can time it apart from
+    # cutting windows
+    cache = pcm_cache.default_cache()
+    if cache is not None:
+        return functools.partial(pcm_cache.cut_window, cache.load(mp3_file))
+
+    whole_clip = pydub.AudioSegment.from_mp3(mp3_file)
+
+    def window(offset, duration):
+        return whole_clip[offset * MS_PER_S : (offset + duration) * MS_PER_S]
+
+    return window
+
+
+def save_clips(segment, outputs):
+    """
+    Encode a clip to several (profile, dest_file) outputs at once, moving
+    each into place only once they're all complete.
+    """
+    encode_clips(segment, outputs)
+    for _, dest_file in outputs:
+        os.replace(dest_file + ".part", dest_file)
+
+
+def encode_clips(segment, outputs):
+    """
+    Encode a clip to a ".part" file beside each (profile, dest_file) output.
+    A single ffmpeg process reads the raw PCM once and writes every output.
+    """
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-nostdin",
+        "-y",
+        "-f",
+        PCM_FORMATS[segment.sample_width],
+        "-ar",
+        str(segment.frame_rate),
+        "-ac",
+        str(segment.channels),
+        "-i",
+        "pipe:0",
+    ]
+    for profile, dest_file in outputs:
+        cmd.extend(["-map", "0:a", "-c:a", profile.codec, "-b:a", profile.bitrate])
+        if profile.frame_rate:
+            cmd.extend(["-ar", str(profile.frame_rate)])
+        if profile.channels:
+            cmd.extend(["-ac", str(min(profile.channels, segment.channels))])
+        cmd.extend(["-f", profile.format, dest_file + ".part"])
+
+    p = subprocess.run(cmd, input=segment.raw_data, stderr=subprocess.PIPE)
+    if p.returncode != 0:
+        raise EncodeError(p.stderr.decode("utf8", "replace"))
+
+
+def normalized(segment, gain=None):
+    """
+    Apply ReplayGain-style volume normalization. The gain is limited so that
+    the segment's peak never clips, like mp3gain -k.
+    """
+    if gain is None:
+        gain = replay_gain(segment)
+    else:
+        gain = min(gain, PEAK_CEILING_DBFS - peak_dbfs(segment))
+
+    return segment.apply_gain(gain)
+
+
+def replay_gain(segment):
+    "The gain in dB needed to bring the segment to the reference loudness."
+    level = loudness(segment)
+    if level is None:
+        return 0.0
+
+    gain = TARGET_LOUDNESS_DBFS - level
+    return round(min(gain, PEAK_CEILING_DBFS - peak_dbfs(segment)), 2)
+
+
+def loudness(segment):
+    """
+    Gated loudness of the segment in dBFS, or None if it's silent. Levels are
+    measured in blocks, ignoring near-silent blocks and those far quieter than
+    the rest, so that pauses don't drag the measurement down.
+    """
+    a = pcm_array(segment)
+    full_scale = float(2 ** (8 * segment.sample_width - 1))
+    block = max(1, int(segment.frame_rate * GATE_BLOCK_S))
+    n_blocks = max(1, len(a) // block)
+
+    blocks = a[: n_blocks * block].reshape((n_blocks, -1)).astype(np.float32)
+    if blocks.size == 0:
+        return None
+
+    power = np.square(blocks / full_scale, dtype=np.float64).mean(axis=1)
+    return gated_loudness(power)
+
+
+def gated_loudness(power):
+    "Loudness in dBFS from an array of mean-square block powers."
+    gated = power[power > 10 ** (ABSOLUTE_GATE_DBFS / 10)]
+    if len(gated) == 0:
+        return None
+
+    relative_gate = gated.mean() * 10 ** (RELATIVE_GATE_DB / 10)
+    gated = gated[gated > relative_gate]
+    return 10 * math.log10(gated.mean())
+
+
+def peak_dbfs(segment):
+    a = pcm_array(segment)
+    if a.size == 0:
+        return 0.0
+
+    full_scale = float(2 ** (8 * segment.sample_width - 1))
+    peak = max(int(a.max()), -int(a.min())) / full_scale
+    return 20 * math.log10(max(peak, 1e-10))
 
 
 def is_bad_mono(segment):
@@ -43,32 +288,24 @@ def is_bad_mono(segment):
     if segment.channels != 2:
         return False
 
+    a = pcm_array(segment)
+    return (a[:, 0] == 0).mean() > BAD_MONO_RATIO or (
+        a[:, 1] == 0
+    ).mean() > BAD_MONO_RATIO
+
+
+def pcm_array(segment):
+    "A zero-copy (frames, channels) view of a segment's signed PCM data."
     w = segment.sample_width
-    if w == 1:
-        dtype = np.uint8
-    elif w == 2:
-        dtype = np.uint16
-    else:
+    if w not in PCM_DTYPES:
         raise Exception("non-standard sample width: {0}".format(w))
 
-    a = np.fromstring(segment._data, dtype=dtype).reshape(
-        (int(segment.frame_count()), segment.channels)
-    )
-    return (a[:, 0] == 0).mean() > 0.4 or (a[:, 1] == 0).mean() > 0.4
-
+    a = np.frombuffer(segment.raw_data, dtype=PCM_DTYPES[w])
+    return a.reshape((-1, segment.channels))
 
-def play_mp3(mp3_file):
-    print("<playing...", end="", flush=True)
-    try:
-        p = afplay(mp3_file, _bg=True, _bg_exc=False)
-        p.wait()
-        print("done>")
-    except (KeyboardInterrupt, sh.SignalException_SIGINT):
-        p.terminate()
-        print("cancelled>")
-        return True
 
-    return True
+class EncodeError(Exception):
+    pass
 
 
 @attributes(["tempfile", Attribute("metadata", default_factory=dict)])
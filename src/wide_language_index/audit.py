@@ -16,26 +16,23 @@ TODO
 
 from __future__ import absolute_import, print_function, division
 
-import csv
+import functools
 import glob
 import hashlib
 import json
 import os
-import unittest
-from typing import Callable
+import subprocess
+import sys
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set
 
 from clint.textui.colored import blue
 import click
-import jsonschema
 
-
-VALID_LANGUAGES = set(r["id"] for r in json.load(open("ext/name_index_20140320.json")))
-
-MACRO_LANGUAGES = set(
-    r["Id"]
-    for r in csv.DictReader(open("ext/iso-639-3.tab"), delimiter="\t")
-    if r["Scope"] == "M"
-)
+from . import mp3scan, reference, validation
 
 OK_MACRO_LANGUAGES = set(
     [
@@ -45,104 +42,334 @@ OK_MACRO_LANGUAGES = set(
     ]
 )
 
+RECORD_PATTERN = "index/*/*.json"
+SAMPLE_PATTERN = "samples/*/*.mp3"
+
+# when the index and samples were last audited and found clean, for
+# --changed-only
+AUDIT_STAMP_FILE = ".cache/audit.json"
+
+# below this many files, starting worker processes costs more than it saves
+PARALLEL_MIN_FILES = 200
+CHUNK_SIZE = 64
+
+Problem = namedtuple("Problem", "filename check message")
+
 
 @click.command()
 @click.option("--skip-audio", is_flag=True, help="Skip audit of audio samples.")
-def main(skip_audio=False):
+@click.option(
+    "--changed-only",
+    is_flag=True,
+    help="Only audit files changed according to git, or since the last clean audit.",
+)
+@click.option(
+    "--strict-sources",
+    is_flag=True,
+    help="Also flag records sharing a source URL, which archive pages often do.",
+)
+@click.option("--workers", type=int, help="Number of worker processes.")
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(["text", "jsonl"]),
+    default="text",
+    help="Report problems as text, or as one JSON object per line.",
+)
+def main(
+    skip_audio=False,
+    changed_only=False,
+    workers=None,
+    fmt="text",
+    strict_sources=False,
+):
     """
     Check the integrity of the index, making sure all records are in the right
     format and containing the right fields. If audio is present, also audit
     the audio against checksums in the index.
     """
-    audit_index()
-
+    targets = [("index", RECORD_PATTERN, audit_record)]
     if not skip_audio:
-        audit_samples()
+        targets.append(("samples", SAMPLE_PATTERN, audit_sample))
+
+    failed = False
+    for name, pattern, audit in targets:
+        started = time.time()
+        changed = changed_filter(name) if changed_only else None
+        if audit_files(name, pattern, audit, changed, workers, fmt):
+            failed = True
+        else:
+            save_audit_stamp(name, started)
+
+    # collisions can involve unchanged files, so this always covers everything
+    problems = audit_consistency(
+        check_samples=not skip_audio, strict_sources=strict_sources
+    )
+    if report("consistency", None, problems, fmt):
+        failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+def audit_files(
+    name: str,
+    pattern: str,
+    audit: Callable[[str], List[Problem]],
+    changed: Optional[Callable[[str], bool]],
+    workers: Optional[int],
+    fmt: str,
+) -> int:
+    "Audit every matching file, reporting problems as they're found."
+    files = sorted(glob.glob(pattern))
+    if changed is not None:
+        files = [f for f in files if changed(f)]
+
+    return report(name, len(files), audit_all(audit, files, workers), fmt)
+
+
+def report(
+    name: str, n_files: Optional[int], problems: Iterable[Problem], fmt: str
+) -> int:
+    "Print problems as they arrive, returning how many there were."
+    if fmt == "text":
+        if n_files is None:
+            print(blue("Auditing {0}...".format(name)))
+        else:
+            print(blue("Auditing {0} ({1} files)...".format(name, n_files)))
+
+    start = time.perf_counter()
+    n_problems = 0
+    for problem in problems:
+        n_problems += 1
+        if fmt == "jsonl":
+            print(json.dumps(problem._asdict(), sort_keys=True), flush=True)
+        else:
+            print("FAIL {0}: [{1}] {2}".format(*problem), flush=True)
+
+    if fmt == "text":
+        print("{0} problems ({1:.2f}s)".format(n_problems, time.perf_counter() - start))
+        print()
+
+    return n_problems
+
+
+def audit_all(
+    audit: Callable[[str], List[Problem]],
+    files: List[str],
+    workers: Optional[int] = None,
+) -> Iterator[Problem]:
+    "Audit files in parallel, yielding problems in file order as they arrive."
+    if len(files) < PARALLEL_MIN_FILES or workers == 1:
+        results: Iterable[List[Problem]] = map(audit, files)
+        for problems in results:
+            yield from problems
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for problems in executor.map(audit, files, chunksize=CHUNK_SIZE):
+            yield from problems
+
+
+def audit_record(filename: str) -> List[Problem]:
+    problems = []
+
+    def fail(check, message):
+        problems.append(Problem(filename, check, message))
+
+    with open(filename, encoding="utf8") as istream:
+        blob = istream.read()
+
+    try:
+        data = json.loads(blob)
+    except ValueError as e:
+        fail("json", str(e))
+        return problems
+
+    for message in validation.sample_errors(data):
+        fail("schema", message)
+
+    # the language code is a valid ISO 693-3 code
+    language = data.get("language")
+    if language not in reference.valid_languages():
+        fail("language", "{0} is not an ISO 639-3 code".format(language))
+
+    # the language is not a macrolanguage
+    if language not in OK_MACRO_LANGUAGES and language in reference.macro_languages():
+        fail("language", "{0} is a macrolanguage".format(language))
+
+    # the record is in the correct directory
+    parent_dir = path.basename(path.dirname(filename))
+    if parent_dir != language:
+        fail("directory", "record for {0} is in {1}/".format(language, parent_dir))
+
+    # it is pretty-printed
+    pretty_blob = json.dumps(data, indent=2, sort_keys=True, ensure_ascii=False)
+    if blob != pretty_blob:
+        fail("format", "not normalized, run make normalize")
+
+    return problems
+
+
+def audit_sample(filename: str) -> List[Problem]:
+    md5 = hashlib.md5()
+    with open(filename, "rb") as istream:
+        for block in iter(lambda: istream.read(2**20), b""):
+            md5.update(block)
+
+    checksum = md5.hexdigest()
+    if checksum not in filename:
+        return [Problem(filename, "checksum", "actual checksum is " + checksum)]
+
+    # frame problems come from the last `make scan`, rather than a new scan
+    scan = cached_scans().get(checksum)
+    if not mp3scan.is_broken(scan):
+        return []
+
+    return [
+        Problem(filename, "mp3", message)
+        for problem, message in zip(scan["problems"], mp3scan.describe(scan))
+        if problem in mp3scan.BROKEN
+    ]
 
 
-def audit_index():
-    print(blue("Auditing index..."))
+@functools.lru_cache(maxsize=None)
+def cached_scans() -> Dict[str, mp3scan.Scan]:
+    "Load the scan results once per process."
+    return mp3scan.load_scans()
 
-    class IndexTestCase(unittest.TestCase):
-        pass
 
-    validator = make_validator()
-    for i, f in enumerate(glob.glob("index/*/*.json")):
-        t = make_test(f, i, validator)
-        assert not hasattr(IndexTestCase, t.__name__)
-        setattr(IndexTestCase, t.__name__, t)
+def audit_consistency(
+    check_samples: bool = True, strict_sources: bool = False
+) -> Iterator[Problem]:
+    """
+    Check the index as a whole in one pass: no checksum or media URL may be
+    shared by two records, nor with strict_sources a source URL. If samples
+    are present, every sample needs a record and every record its sample.
+    """
+    by_checksum: Dict[str, List[str]] = defaultdict(list)
+    by_source_url: Dict[str, List[str]] = defaultdict(list)
+    by_media_url: Dict[str, List[str]] = defaultdict(list)
+    expected_samples: Dict[str, str] = {}
+
+    for f in sorted(glob.glob(RECORD_PATTERN)):
+        try:
+            with open(f, encoding="utf8") as istream:
+                rec = json.load(istream)
+        except ValueError:
+            # already reported by the record audit
+            continue
+
+        checksum = rec.get("checksum")
+        language = rec.get("language")
+        if checksum:
+            by_checksum[checksum].append(f)
+            expected_samples["samples/{0}/{0}-{1}.mp3".format(language, checksum)] = f
+        if rec.get("source_url"):
+            by_source_url[rec["source_url"]].append(f)
+        for url in set(rec.get("media_urls", ())):
+            by_media_url[url].append(f)
+
+    indexes = [("checksum", by_checksum), ("media_url", by_media_url)]
+    if strict_sources:
+        indexes.append(("source_url", by_source_url))
+
+    for kind, index in indexes:
+        for key, files in index.items():
+            for f in files[1:]:
+                yield Problem(
+                    f, "duplicate", "{0} {1} is also in {2}".format(kind, key, files[0])
+                )
+
+    if not check_samples:
+        return
+
+    samples = set(
+        f
+        for f in glob.glob(SAMPLE_PATTERN)
+        if not path.basename(path.dirname(f)).startswith("_")
+    )
+    if not samples:
+        # no samples have been fetched, so there's nothing to compare
+        return
 
-    unittest.TextTestRunner().run(unittest.makeSuite(IndexTestCase))
-    print()
+    for f in sorted(samples.difference(expected_samples)):
+        yield Problem(f, "orphan", "sample has no record in the index")
 
+    for sample_file, f in sorted(expected_samples.items()):
+        if sample_file not in samples:
+            yield Problem(f, "missing", "sample {0} is missing".format(sample_file))
 
-def make_validator() -> Callable[[dict], None]:
-    "Make a function that can validate sample records."
-    sample_schema = json.load(open("index/sample.schema.json"))
-    base_uri = "file://" + os.path.abspath("index") + "/"
-    resolver = jsonschema.RefResolver(
-        referrer=sample_schema,
-        base_uri=base_uri,
-    )
-    validator = jsonschema.Draft4Validator(sample_schema, resolver=resolver)
 
-    return validator.validate
+def changed_filter(name: str) -> Callable[[str], bool]:
+    """
+    Make a predicate for files that are new or modified according to git, or
+    modified since the last audit of them that found nothing wrong.
+    """
+    in_git = git_changed_files()
+    since = load_audit_stamp(name)
 
+    def changed(filename: str) -> bool:
+        if in_git is not None and filename in in_git:
+            return True
 
-def audit_samples():
-    print(blue("Auditing samples..."))
+        if since is None:
+            # with nothing else to go on, audit everything
+            return in_git is None
 
-    class SampleTestCase(unittest.TestCase):
-        pass
+        return os.stat(filename).st_mtime > since
 
-    samples = sorted(glob.glob("samples/*/*.mp3"))
-    for i, sample in enumerate(samples):
-        t = make_sample_test(sample, i)
-        assert not hasattr(SampleTestCase, t.__name__)
-        setattr(SampleTestCase, t.__name__, t)
+    return changed
 
-    unittest.TextTestRunner().run(unittest.makeSuite(SampleTestCase))
-    print()
 
+def git_changed_files() -> Optional[Set[str]]:
+    "Files that differ from HEAD or are untracked, or None outside a repo."
+    try:
+        p = subprocess.run(
+            ["git", "status", "--porcelain", "-z", "--untracked-files=all"],
+            capture_output=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
 
-def make_test(f, i, validate):
-    def t(self):
-        blob = open(f).read()
-        data = json.loads(blob)
-        validate(data)
+    changed = set()
+    entries = p.stdout.decode("utf8").split("\0")
+    i = 0
+    while i < len(entries):
+        entry = entries[i]
+        i += 1
+        if len(entry) < 4:
+            continue
 
-        # the language code is a valid ISO 693-3 code
-        language = data.get("language")
-        assert language in VALID_LANGUAGES, language
+        status, filename = entry[:2], entry[3:]
+        if "R" in status or "C" in status:
+            # renames and copies are followed by their original name
+            i += 1
 
-        # the language is not a macrolanguage
-        assert language in OK_MACRO_LANGUAGES or language not in MACRO_LANGUAGES, (
-            language
-        )
+        changed.add(filename)
 
-        # the record is in the correct directory
-        parent_dir = os.path.basename(os.path.dirname(f))
-        self.assertEqual(parent_dir, language)
+    return changed
 
-        # it is pretty-printed
-        pretty_blob = json.dumps(data, indent=2, sort_keys=True, ensure_ascii=False)
-        assert blob == pretty_blob, f
 
-    name = "test_doc_{0}".format(i)
-    t.__name__ = name
-    return t
+def load_audit_stamps() -> Dict[str, float]:
+    try:
+        with open(AUDIT_STAMP_FILE) as istream:
+            return json.load(istream)
+    except (OSError, ValueError):
+        return {}
 
 
-def make_sample_test(sample_file, i):
-    def t(self):
-        with open(sample_file, "rb") as istream:
-            checksum = hashlib.md5(istream.read()).hexdigest()
+def load_audit_stamp(name: str) -> Optional[float]:
+    return load_audit_stamps().get(name)
 
-        assert checksum in sample_file
 
-    name = "test_sample_{0}".format(i)
-    t.__name__ = name
-    return t
+def save_audit_stamp(name: str, started: float) -> None:
+    stamps = load_audit_stamps()
+    stamps[name] = started
+    os.makedirs(path.dirname(AUDIT_STAMP_FILE), exist_ok=True)
+    with open(AUDIT_STAMP_FILE, "w") as ostream:
+        json.dump(stamps, ostream, indent=2, sort_keys=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+#  cli.py
+#  wide-language-index
+#
+
+"""
+A single `wli` command for every tool in the index. Subcommands are only
+imported when they're run, so that light commands don't pay for the heavy
+dependencies of others.
+"""
+
+import importlib
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from typing import Dict, List, Optional, Tuple
+
+import click
+
+LazyCommand = namedtuple("LazyCommand", "target help")
+
+COMMANDS: Dict[str, LazyCommand] = {
+    "add-sample": LazyCommand("add_sample:main", "Add a language example."),
+    "analyze": LazyCommand(
+        "analysis:analyze_samples", "Cache audio health statistics."
+    ),
+    "annotate": LazyCommand("annotate:main", "Start an annotation session."),
+    "audit": LazyCommand("audit:main", "Check the integrity of the index."),
+    "clips": LazyCommand(
+        "generate_clips:make_clips", "Make clips for every good annotation."
+    ),
+    "fetch": LazyCommand("fetch_index:fetch_index", "Fetch every sample."),
+    "fetch-language-data": LazyCommand(
+        "fetch_language_data:main", "Fetch language data from Wikipedia."
+    ),
+    "mirror": LazyCommand("mirror:main", "Mirror samples to S3."),
+    "normalize": LazyCommand(
+        "normalize:normalize_json_files", "Reformat all JSON records."
+    ),
+    "play-offset": LazyCommand(
+        "play_offset:play_offset_cmd", "Play part of an audio file."
+    ),
+    "recode-language": LazyCommand(
+        "recode_language:main", "Recode one language code to another."
+    ),
+    "recode-sample": LazyCommand(
+        "recode_sample:main", "Recode a sample to another language."
+    ),
+    "rss": LazyCommand("fetch_rss_feed:main", "Scrape RSS feeds for new samples."),
+    "scan": LazyCommand(
+        "mp3scan:scan_samples", "Check the MP3 frames of every sample."
+    ),
+    "serve": LazyCommand(
+        "annotation_server:main", "Serve annotation to many people over HTTP."
+    ),
+    "stats": LazyCommand(
+        "annotation_stats:annotation_stats", "Summarize annotations in Markdown."
+    ),
+}
+
+BENCH_REPEAT = 3
+
+
+class LazyGroup(click.Group):
+    "A group that imports each subcommand's module only when it's invoked."
+
+    def list_commands(self, ctx: click.Context) -> List[str]:
+        return sorted(set(COMMANDS) | set(self.commands))
+
+    def get_command(self, ctx: click.Context, name: str) -> Optional[click.Command]:
+        if name in self.commands:
+            return self.commands[name]
+
+        if name not in COMMANDS:
+            return None
+
+        module, attr = COMMANDS[name].target.split(":")
+        command = getattr(importlib.import_module("." + module, __package__), attr)
+        if not isinstance(command, click.Command):
+            # a plain function taking no arguments
+            command = click.Command(name, callback=command, help=COMMANDS[name].help)
+
+        return command
+
+    def format_commands(
+        self, ctx: click.Context, formatter: click.HelpFormatter
+    ) -> None:
+        # list commands from their registered help, rather than importing them
+        rows = [(name, c.help) for name, c in COMMANDS.items()]
+        rows.extend((name, c.get_short_help_str()) for name, c in self.commands.items())
+        with formatter.section("Commands"):
+            formatter.write_dl(sorted(rows))
+
+
+@click.group(cls=LazyGroup)
+def main():
+    "Tools for building and maintaining the Wide Language Index."
+
+
+@main.command("bench-startup")
+@click.argument("commands", nargs=-1)
+@click.option(
+    "--repeat",
+    type=int,
+    default=BENCH_REPEAT,
+    help="Runs per command, keeping the fastest.",
+)
+def bench_startup(commands: Tuple[str, ...], repeat: int = BENCH_REPEAT) -> None:
+    """
+    Report the cold-start cost of each command: how long importing it takes,
+    as measured by -X importtime, and the wall-clock time of `wli COMMAND
+    --help`, along with its heaviest direct imports.
+    """
+    commands = commands or tuple(sorted(COMMANDS))
+    unknown = [c for c in commands if c not in COMMANDS]
+    if unknown:
+        raise click.BadParameter("unknown command: " + ", ".join(unknown))
+
+    print(
+        "{:>20s} {:>10s} {:>8s}  {}".format(
+            "command", "import ms", "wall ms", "heaviest"
+        )
+    )
+    for name in commands:
+        module = "{0}.{1}".format(__package__, COMMANDS[name].target.split(":")[0])
+        try:
+            import_us, heaviest = min(
+                (measure_import(module) for _ in range(repeat)), key=lambda r: r[0]
+            )
+            wall_s = min(measure_help(name) for _ in range(repeat))
+        except subprocess.CalledProcessError as e:
+            last_line = (e.stderr or "").strip().splitlines()[-1:]
+            print("{:>20s} failed: {}".format(name, "".join(last_line)))
+            continue
+
+        print(
+            "{:>20s} {:>10.1f} {:>8.1f}  {}".format(
+                name,
+                import_us / 1000,
+                wall_s * 1000,
+                ", ".join("{0} {1:.0f}".format(m, us / 1000) for m, us in heaviest[:3]),
+            )
+        )
+
+
+def measure_import(module: str) -> Tuple[int, List[Tuple[str, int]]]:
+    """
+    Import the module in a fresh interpreter. Return its cumulative import time
+    in microseconds, and its direct imports heaviest first.
+    """
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return parse_importtime(p.stderr, module)
+
+
+def parse_importtime(output: str, module: str) -> Tuple[int, List[Tuple[str, int]]]:
+    # lines look like "import time:   self |   cumulative | <indent>name", and
+    # each module is listed after everything it imported
+    children: List[Tuple[str, int]] = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+
+        _, cumulative, name_field = line[len("import time:") :].split("|")
+        name = name_field.strip()
+        depth = (len(name_field) - len(name_field.lstrip()) - 1) // 2
+
+        if depth == 1:
+            children.append((name, int(cumulative)))
+        elif depth == 0:
+            if name == module:
+                return int(cumulative), sorted(children, key=lambda c: -c[1])
+            children = []
+
+    return 0, []
+
+
+def measure_help(name: str) -> float:
+    "Wall-clock seconds to start a fresh `wli NAME --help`."
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-m", __package__ + ".cli", name, "--help"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()
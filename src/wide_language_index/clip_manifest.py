@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+#  clip_manifest.py
+#  wide-language-index
+#
+
+"""
+A record of every clip that has been generated, and exactly how, so that
+clip generation can tell which clips are missing, stale or orphaned without
+touching the clips themselves.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import re
+from os import path
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import analysis, audio
+
+CLIP_DIR = "samples/_annotated"
+MANIFEST_FILE = CLIP_DIR + "/manifest.json"
+
+# bump this whenever clip processing changes in a way that should force every
+# clip to be regenerated
+CLIP_VERSION = 1
+
+# clips from before profiles, at samples/_annotated/<lang>/<clip>.mp3, and now
+# built under the mp3 profile with the same name
+LEGACY_CLIP = re.compile(r"^([a-z]{3})-([0-9a-f]{32})-[0-9.]+-[0-9.]+\.mp3$")
+LEGACY_PROFILE = "mp3"
+
+# what the sample's cached analysis decides for a clip, and which analysis
+ANALYSIS_FIELDS = ("gain", "bad_mono", "analysis_version", "analysis_stamp")
+
+Spec = Dict[str, Any]
+Manifest = Dict[str, Spec]
+
+
+def clip_spec(
+    checksum: str,
+    offset: float,
+    duration: float,
+    pregain: Optional[str],
+    profile: str,
+    analysed: Spec,
+) -> Spec:
+    """
+    Everything that determines the contents of a clip, including what the
+    sample's analysis decided, so that re-analysing a sample marks its clips
+    stale.
+    """
+    return {
+        "checksum": checksum,
+        "offset": offset,
+        "duration": duration,
+        "pregain": pregain,
+        **analysed,
+        "profile": profile,
+        "encoding": list(audio.PROFILES[profile][1:]),
+        "version": CLIP_VERSION,
+    }
+
+
+def analysis_fields(
+    pregain: Optional[str],
+    health: Optional[analysis.Health],
+    stamp: Optional[str],
+    offset: float,
+    duration: float,
+) -> Spec:
+    """
+    What a sample's cached analysis decides about a clip's gain and mono
+    channels. Without an analysis, mono is decided from the clip's own audio
+    and recorded as None.
+    """
+    return {
+        "gain": analysis.sample_gain(pregain, health),
+        "bad_mono": (
+            analysis.is_bad_mono_window(health, offset, duration) if health else None
+        ),
+        "analysis_version": health["version"] if health else None,
+        "analysis_stamp": stamp,
+    }
+
+
+def recorded_analysis(
+    manifest: Manifest, clip_file: str, pregain: Optional[str], stamp: Optional[str]
+) -> Optional[Spec]:
+    """
+    The analysis fields a clip was built with, if neither the sample's
+    analysis nor its pregain has changed since, so they needn't be worked
+    out again.
+    """
+    entry = manifest.get(clip_file)
+    if (
+        entry is None
+        or entry.get("analysis_stamp") != stamp
+        or entry.get("pregain") != pregain
+    ):
+        return None
+
+    return {k: entry[k] for k in ANALYSIS_FIELDS}
+
+
+def is_current(manifest: Manifest, clip_file: str, spec: Spec) -> bool:
+    "Was this clip already built to the given spec?"
+    entry = manifest.get(clip_file)
+    if entry is None:
+        return False
+
+    return {k: v for k, v in entry.items() if k != "md5"} == spec
+
+
+def legacy_clips() -> List[Tuple[str, str, str]]:
+    """
+    Clips left in the old per-language layout, which no manifest tracks, as
+    (filename, checksum, replacement) for the same clip in the new layout.
+    """
+    clips = []
+    for f in sorted(glob.glob(path.join(CLIP_DIR, "*", "*.mp3"))):
+        name = path.basename(f)
+        match = LEGACY_CLIP.match(name)
+        language = path.basename(path.dirname(f))
+        if match is not None and match.group(1) == language:
+            replacement = path.join(CLIP_DIR, LEGACY_PROFILE, language, name)
+            clips.append((f, match.group(2), replacement))
+
+    return clips
+
+
+def manifest_filename(shard: Optional[Tuple[int, int]] = None) -> str:
+    "Each shard of a distributed build keeps its own manifest."
+    if shard is None:
+        return MANIFEST_FILE
+
+    i, n = shard
+    return "{0}/manifest.{1}-of-{2}.json".format(CLIP_DIR, i + 1, n)
+
+
+def load_manifest(filename: str = MANIFEST_FILE) -> Manifest:
+    if not path.exists(filename):
+        return {}
+
+    with open(filename) as istream:
+        return json.load(istream)
+
+
+def save_manifest(manifest: Manifest, filename: str = MANIFEST_FILE) -> None:
+    os.makedirs(path.dirname(filename), exist_ok=True)
+
+    # write atomically, so an interrupted run never loses the manifest
+    tmp_file = filename + ".tmp"
+    with open(tmp_file, "w") as ostream:
+        json.dump(manifest, ostream, indent=2, sort_keys=True)
+    os.replace(tmp_file, filename)
+
+
+def file_md5(filename: str) -> str:
+    with open(filename, "rb") as istream:
+        return hashlib.md5(istream.read()).hexdigest()
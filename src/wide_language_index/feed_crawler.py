@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+#
+#  feed_crawler.py
+#  wide-language-index
+#
+
+"""
+Fetch many RSS feeds at once, with a limit on connections to each host. The
+ETag and Last-Modified of every feed are kept along with its body, so that a
+feed which hasn't changed costs a single 304 on the next crawl.
+
+Episode pages that have to be scraped for their audio are resolved the same
+way, and what was found on each is remembered, so that pages are only
+fetched once. Pages without audio are retried after a while, in case they
+were fixed.
+"""
+
+import asyncio
+import collections
+import contextlib
+import hashlib
+import json
+import os
+import time
+from collections import namedtuple
+from os import path
+from typing import Callable, Dict, Iterable, List, Optional
+from urllib.parse import urlparse
+
+import aiohttp
+
+CACHE_DIR = ".cache/rss"
+STATE_FILE = path.join(CACHE_DIR, "feeds.json")
+EPISODE_FILE = path.join(CACHE_DIR, "episodes.json")
+
+# how long to trust that an episode page has no audio
+NEGATIVE_TTL_S = 7 * 24 * 3600
+
+MAX_CONNECTIONS = 32
+MAX_PER_HOST = 4
+
+# per connection attempt and per read, never counting time spent waiting for
+# a free connection, since many feeds share a host
+CONNECT_TIMEOUT_S = 20
+READ_TIMEOUT_S = 60
+
+# the outcome of fetching one feed; body is None if it failed
+FeedResult = namedtuple("FeedResult", "url status body content_type elapsed error")
+
+
+class HostSlots(object):
+    """
+    Hold requests back until a connection to their host is free, so that
+    their latency and timeouts only start once they can actually be sent.
+    """
+
+    def __init__(self, max_per_host: int = MAX_PER_HOST):
+        self.total = asyncio.Semaphore(MAX_CONNECTIONS)
+        self.per_host: Dict[str, asyncio.Semaphore] = collections.defaultdict(
+            lambda: asyncio.Semaphore(max_per_host)
+        )
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, url: str):
+        # wait on the host first, so a queued request never holds a slot overall
+        async with self.per_host[urlparse(url).netloc]:
+            async with self.total:
+                yield
+
+
+def crawl(
+    urls: Iterable[str],
+    user_agent: Optional[str] = None,
+    max_per_host: int = MAX_PER_HOST,
+) -> Dict[str, FeedResult]:
+    "Fetch every feed concurrently, reusing cached bodies that haven't changed."
+    return asyncio.run(async_crawl(urls, user_agent, max_per_host))
+
+
+async def async_crawl(
+    urls: Iterable[str],
+    user_agent: Optional[str] = None,
+    max_per_host: int = MAX_PER_HOST,
+) -> Dict[str, FeedResult]:
+    urls = list(dict.fromkeys(urls))
+    state = load_state()
+
+    slots = HostSlots(max_per_host)
+    async with _session(user_agent, max_per_host) as session:
+        results = await asyncio.gather(
+            *(fetch_feed(session, slots, url, state) for url in urls)
+        )
+
+    save_state(state)
+    print_stats(results)
+
+    return {r.url: r for r in results}
+
+
+async def fetch_feed(
+    session: aiohttp.ClientSession,
+    slots: HostSlots,
+    url: str,
+    state: Dict[str, Dict],
+) -> FeedResult:
+    "Fetch one feed, with a conditional request if we've seen it before."
+    cached = state.get(url, {})
+    body_file = _body_file(url)
+    have_body = path.exists(body_file)
+
+    headers = {}
+    if have_body:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    # only start the clock once a connection is ours
+    async with slots.acquire(url):
+        start = time.perf_counter()
+        try:
+            async with session.get(url, headers=headers) as resp:
+                if resp.status == 304 and have_body:
+                    with open(body_file, "rb") as istream:
+                        body = istream.read()
+                    content_type = cached.get("content_type")
+
+                elif resp.status == 200:
+                    body = await resp.read()
+                    content_type = resp.headers.get("Content-Type")
+                    _write_atomic(body_file, body)
+                    state[url] = {
+                        "etag": resp.headers.get("ETag"),
+                        "last_modified": resp.headers.get("Last-Modified"),
+                        "content_type": content_type,
+                    }
+
+                else:
+                    return FeedResult(
+                        url,
+                        resp.status,
+                        None,
+                        None,
+                        time.perf_counter() - start,
+                        "HTTP {0}".format(resp.status),
+                    )
+
+                return FeedResult(
+                    url,
+                    resp.status,
+                    body,
+                    content_type,
+                    time.perf_counter() - start,
+                    None,
+                )
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            return FeedResult(
+                url, None, None, None, time.perf_counter() - start, str(e) or repr(e)
+            )
+
+
+def resolve_pages(
+    urls: Iterable[str],
+    extract: Callable[[bytes], List[str]],
+    user_agent: Optional[str] = None,
+    max_per_host: int = MAX_PER_HOST,
+) -> Dict[str, List[str]]:
+    """
+    Map each episode page to the audio links that extract() finds in it,
+    fetching concurrently only the pages we don't already know about.
+    """
+    return asyncio.run(async_resolve_pages(urls, extract, user_agent, max_per_host))
+
+
+async def async_resolve_pages(
+    urls: Iterable[str],
+    extract: Callable[[bytes], List[str]],
+    user_agent: Optional[str] = None,
+    max_per_host: int = MAX_PER_HOST,
+) -> Dict[str, List[str]]:
+    urls = list(dict.fromkeys(urls))
+    episodes = load_episodes()
+    now = time.time()
+
+    def is_fresh(entry: Optional[Dict]) -> bool:
+        return entry is not None and (
+            bool(entry["audio_links"]) or now - entry["resolved_at"] < NEGATIVE_TTL_S
+        )
+
+    to_fetch = [u for u in urls if not is_fresh(episodes.get(u))]
+    print(
+        "Resolving {0} episode pages, {1} already known".format(
+            len(to_fetch), len(urls) - len(to_fetch)
+        )
+    )
+
+    if to_fetch:
+        slots = HostSlots(max_per_host)
+        async with _session(user_agent, max_per_host) as session:
+            found = await asyncio.gather(
+                *(fetch_page(session, slots, u, extract) for u in to_fetch)
+            )
+
+        for url, audio_links in zip(to_fetch, found):
+            if audio_links is not None:
+                episodes[url] = {"audio_links": audio_links, "resolved_at": now}
+
+        save_episodes(episodes)
+
+    return {u: episodes[u]["audio_links"] for u in urls if u in episodes}
+
+
+async def fetch_page(
+    session: aiohttp.ClientSession,
+    slots: HostSlots,
+    url: str,
+    extract: Callable[[bytes], List[str]],
+) -> Optional[List[str]]:
+    """
+    Fetch a page and extract its audio links. A page that's gone counts as
+    having none, but other failures may be temporary and return None.
+    """
+    try:
+        async with slots.acquire(url), session.get(url) as resp:
+            if 400 <= resp.status < 500:
+                return []
+
+            if resp.status != 200:
+                print("FAIL {0}: HTTP {1}".format(url, resp.status))
+                return None
+
+            html = await resp.read()
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print("FAIL {0}: {1}".format(url, str(e) or repr(e)))
+        return None
+
+    return extract(html)
+
+
+def print_stats(results: List[FeedResult]) -> None:
+    "Summarize latency and failures, overall and for each host."
+    by_host: Dict[str, List[FeedResult]] = {}
+    for r in results:
+        by_host.setdefault(urlparse(r.url).netloc, []).append(r)
+        if r.error:
+            print("FAIL {0} ({1:.2f}s): {2}".format(r.url, r.elapsed, r.error))
+
+    print(
+        "{:>32s} {:>5s} {:>5s} {:>5s} {:>8s} {:>8s}".format(
+            "host", "new", "304", "fail", "mean s", "max s"
+        )
+    )
+    for host, rs in sorted(by_host.items()):
+        print(_stats_row(host, rs))
+    print(_stats_row("total", results))
+
+
+def _stats_row(name: str, results: List[FeedResult]) -> str:
+    elapsed = [r.elapsed for r in results]
+    return "{:>32s} {:>5d} {:>5d} {:>5d} {:>8.2f} {:>8.2f}".format(
+        name[-32:],
+        sum(r.status == 200 for r in results),
+        sum(r.status == 304 and r.body is not None for r in results),
+        sum(r.body is None for r in results),
+        sum(elapsed) / max(len(elapsed), 1),
+        max(elapsed, default=0.0),
+    )
+
+
+def _session(user_agent: Optional[str], max_per_host: int) -> aiohttp.ClientSession:
+    headers = {"User-Agent": user_agent} if user_agent else {}
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, limit_per_host=max_per_host)
+    timeout = aiohttp.ClientTimeout(
+        total=None, sock_connect=CONNECT_TIMEOUT_S, sock_read=READ_TIMEOUT_S
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers)
+
+
+def _body_file(url: str) -> str:
+    return path.join(CACHE_DIR, hashlib.md5(url.encode("utf8")).hexdigest() + ".xml")
+
+
+def load_state() -> Dict[str, Dict]:
+    try:
+        with open(STATE_FILE) as istream:
+            return json.load(istream)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state: Dict[str, Dict]) -> None:
+    _write_atomic(STATE_FILE, json.dumps(state, indent=2, sort_keys=True).encode())
+
+
+def load_episodes() -> Dict[str, Dict]:
+    try:
+        with open(EPISODE_FILE) as istream:
+            return json.load(istream)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_episodes(episodes: Dict[str, Dict]) -> None:
+    _write_atomic(EPISODE_FILE, json.dumps(episodes, indent=2, sort_keys=True).encode())
+
+
+def _write_atomic(filename: str, data: bytes) -> None:
+    os.makedirs(path.dirname(filename), exist_ok=True)
+    tmp_file = filename + ".tmp"
+    with open(tmp_file, "wb") as ostream:
+        ostream.write(data)
+    os.replace(tmp_file, filename)
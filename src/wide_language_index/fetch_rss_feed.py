@@ -15,7 +15,7 @@ from pyquery import PyQuery as pq
 import click
 import feedparser
 
-import index
+from . import feed_crawler, index, ingest, probe
 
 
 RSS_FEEDS = "data/rss_feeds.json"
@@ -47,14 +47,67 @@ def main(max_per_feed=5, language_cap=50, language=None):
         else [language]
     )
 
-    for l in languages:
-        for p in iter_language_posts(l, feeds[l], max_per_feed):
-            if is_good_post(p, seen):
-                ok = save_post(p, seen)
-                count[l] += ok
+    # fetch every feed up front, all at once
+    crawled = feed_crawler.crawl(
+        [f["rss_url"] for l in languages for f in feeds[l]],
+        user_agent=DEFAULT_USER_AGENT,
+    )
+    entries = {
+        f["rss_url"]: parse_feed(f, crawled[f["rss_url"]])
+        for l in languages
+        for f in feeds[l]
+    }
+
+    # likewise any episode pages we'll need to scrape for audio
+    pages = feed_crawler.resolve_pages(
+        [
+            e["link"]
+            for l in languages
+            for f in feeds[l]
+            for e in entries[f["rss_url"]][:max_per_feed]
+            if needs_episode_page(e, f)
+        ],
+        audio_links,
+        user_agent=DEFAULT_USER_AGENT,
+    )
 
-                if count[l] >= language_cap:
-                    break
+    probes = probe.ProbeIndex.load()
+    probes.update_from_samples()
+    try:
+        with ingest.IngestPipeline(
+            seen, probes, user_agent=DEFAULT_USER_AGENT
+        ) as pipeline:
+
+            def finish(job):
+                count[job.language] += finish_post(job, seen, probes)
+
+            for l in languages:
+                for p in iter_language_posts(l, feeds[l], max_per_feed, entries, pages):
+                    # posts in flight count towards the cap until they're done,
+                    # so wait to see if they succeed before starting more
+                    while pipeline.full() or (
+                        pipeline.in_flight[l]
+                        and count[l] + pipeline.in_flight[l] >= language_cap
+                    ):
+                        finish(pipeline.next_done())
+
+                    if count[l] >= language_cap:
+                        break
+
+                    if is_good_post(p, seen):
+                        # claim its urls, so a repeat of it isn't fetched alongside
+                        seen.add(p["source_url"])
+                        seen.update(p["media_urls"])
+                        try:
+                            pipeline.submit(p)
+                        except index.CodecError as e:
+                            print("      SKIPPING: {0}".format(e))
+
+            for job in pipeline.drain():
+                finish(job)
+
+    finally:
+        probes.save()
 
 
 def load_feeds():
@@ -72,16 +125,31 @@ def load_feeds():
     return by_lang
 
 
-def iter_language_posts(language, feeds, max_per_post):
+def iter_language_posts(language, feeds, max_per_post, entries, pages):
     yield from itertools.chain(
-        *(itertools.islice(iter_feed_posts(f), max_per_post) for f in feeds)
+        *(
+            itertools.islice(iter_feed_posts(f, entries, pages), max_per_post)
+            for f in feeds
+        )
     )
 
 
-def iter_feed_posts(feed):
-    rss_url = feed["rss_url"]
-    rss = feedparser.parse(rss_url)
-    for i, e in enumerate(rss.entries):
+def parse_feed(feed, result):
+    "Parse a crawled feed into its entries, or none if it couldn't be fetched."
+    if result.body is None:
+        print(
+            "[{0}] {1}: SKIPPING, {2}".format(
+                feed["language"], feed["source_name"], result.error
+            )
+        )
+        return []
+
+    headers = {"content-type": result.content_type} if result.content_type else None
+    return feedparser.parse(result.body, response_headers=headers).entries
+
+
+def iter_feed_posts(feed, entries, pages):
+    for i, e in enumerate(entries[feed["rss_url"]]):
         title = e["title"]
         print(
             "[{0}] {1}: {2}".format(
@@ -90,7 +158,7 @@ def iter_feed_posts(feed):
                 title,
             )
         )
-        media_url = detect_media_url(e, feed)
+        media_url = detect_media_url(e, feed, pages)
         source_url = e.get("link", media_url)
 
         t = e["published_parsed"]
@@ -105,15 +173,32 @@ def iter_feed_posts(feed):
         }
 
 
-def detect_media_url(episode, feed):
-    for strategy in [use_episode_link, use_audio_enclosure, follow_episode_link]:
+def detect_media_url(episode, feed, pages):
+    for strategy in [use_episode_link, use_audio_enclosure]:
         media_url = strategy(episode, feed)
         if media_url is not None:
             return media_url
 
+    media_url = follow_episode_link(episode, feed, pages)
+    if media_url is not None:
+        return media_url
+
     raise Exception("no audio found for this podcast")
 
 
+def needs_episode_page(e, feed):
+    "Whether the only way to find this episode's audio is to scrape its page."
+    try:
+        return (
+            "link" in e
+            and use_episode_link(e, feed) is None
+            and use_audio_enclosure(e, feed) is None
+        )
+    except Exception:
+        # a bad enclosure, which will be reported when we reach it
+        return False
+
+
 def use_episode_link(e, feed):
     if "link" in e and e["link"].endswith(".mp3"):
         return e["link"]
@@ -131,26 +216,28 @@ def use_audio_enclosure(e, feed):
             return audio_links[0]
 
 
-def follow_episode_link(e, feed):
+def follow_episode_link(e, feed, pages):
     if "link" not in e:
         return
 
-    allow_multiple = "multiple_audio" in feed
-    return get_audio_link(e["link"], allow_multiple=allow_multiple)
+    files = pages.get(e["link"])
+    if files:
+        if len(set(files)) > 1 and "multiple_audio" not in feed:
+            raise Exception(
+                "too many audio files to choose from: {0}".format(e["link"])
+            )
 
+        return files[0]
 
-def get_audio_link(url, allow_multiple=False):
-    d = pq(url=url)
-    files = [
+
+def audio_links(html):
+    "Find every link to an audio file in an episode page."
+    d = pq(html)
+    return [
         a.attrib["href"]
         for a in d("a")
         if "href" in a.attrib and is_audio_url(a.attrib["href"])
     ]
-    if files:
-        if len(set(files)) > 1 and not allow_multiple:
-            raise Exception("too many audio files to choose from: {0}".format(url))
-
-        return list(files)[0]
 
 
 def is_audio_url(url):
@@ -161,24 +248,40 @@ def is_good_post(p, seen):
     return p["source_url"] not in seen and p["media_urls"][0] not in seen
 
 
-def save_post(sample, seen):
+def finish_post(job, seen, probes):
+    "Save the record for a post that's been through the ingest pipeline."
+    sample = job.sample
     (media_url,) = sample["media_urls"]
 
-    try:
-        staged = index.stage_audio(media_url, sample["language"])
-    except index.DownloadError:
-        print("      SKIPPING: got 404 when downloading")
+    if job.duplicate is not None:
+        print("      SKIPPING {0}: same audio as {1}".format(media_url, job.duplicate))
+        if job.probed.fingerprint is not None:
+            probes.add(job.probed.fingerprint, job.duplicate, job.probed)
+        return False
+
+    if isinstance(job.error, index.DownloadError):
+        print("      SKIPPING {0}: got 404 when downloading".format(media_url))
         return False
 
+    if job.error is not None:
+        print("      SKIPPING {0}: {1!r}".format(media_url, job.error))
+        return False
+
+    staged = job.staged
+
+    # remember the original, so the next copy of it isn't downloaded; it maps
+    # to the sample's own checksum, since that's what the index is checked by
+    probes.add(staged.fingerprint, staged.checksum, job.probed)
+
     sample["checksum"] = staged.checksum
     if staged.checksum in seen:
-        print("      SKIPPING: checksum already in index")
+        print("      SKIPPING {0}: checksum already in index".format(media_url))
         return False
 
     if staged.orig_checksum:
         sample["origin_checksum"] = staged.orig_checksum
         if staged.orig_checksum in seen:
-            print("      SKIPPING: checksum already in index")
+            print("      SKIPPING {0}: checksum already in index".format(media_url))
             return False
 
     index.save(sample)
@@ -5,29 +5,148 @@
 #  wide-language-index
 #
 
+import asyncio
+import collections
+import datetime
 import glob
 import json
 import os
 import shutil
-from concurrent.futures import ProcessPoolExecutor, as_completed
-from typing import Dict, List, Tuple
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, as_completed
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 import click
 
-from . import audio
+from . import (
+    analysis,
+    audio,
+    clip_manifest,
+    fetch_index,
+    mp3scan,
+    pcm_cache,
+    timing,
+)
+
+
+# how many samples to download at once with --fetch
+FETCH_CONCURRENCY = 8
+
+# samples are hashed into this many buckets when sharding the work
+SHARD_BUCKETS = 256
+
+# how many clips' worth of work it takes to decode a sample
+DECODE_WEIGHT = 4
+
+# (language, checksum, pregain, ((offset, duration), ...))
+Source = Tuple[str, str, Optional[str], Tuple[Tuple[float, float], ...]]
+
+# (language, checksum, pregain, ((offset, duration, (profile, ...)), ...))
+ClipTask = Tuple[
+    str, str, Optional[str], Tuple[Tuple[float, float, Tuple[str, ...]], ...]
+]
 
 
 @click.command()
 @click.option("--workers", default=None, type=int, help="Number of worker processes")
-def make_clips(workers: int = None):
+@click.option(
+    "--pcm-cache-mb", type=int, help="Cache decoded audio, up to this size on disk."
+)
+@click.option(
+    "--profile",
+    "profiles",
+    multiple=True,
+    default=["mp3"],
+    type=click.Choice(sorted(audio.PROFILES)),
+    help="Output profile to encode clips with, may be repeated [mp3].",
+)
+@click.option(
+    "--verify", is_flag=True, help="Check clips on disk against the manifest."
+)
+@click.option(
+    "--shard",
+    callback=lambda ctx, param, value: parse_shard(value),
+    help="Only build one share of the clips, given as i/n (e.g. 2/4).",
+)
+@click.option(
+    "--merge",
+    "merge_dirs",
+    multiple=True,
+    type=click.Path(exists=True, file_okay=False),
+    help="Merge clips and manifests from a shard's _annotated folder.",
+)
+@click.option("--fetch", is_flag=True, help="Download missing samples as needed.")
+@click.option(
+    "--prefer-mirrors", is_flag=True, help="Try mirrors before the original source."
+)
+@click.option(
+    "--timings",
+    "timings_file",
+    type=click.Path(dir_okay=False),
+    help="Append per-sample stage timings to this JSON lines file.",
+)
+def make_clips(
+    workers: int = None,
+    pcm_cache_mb: int = None,
+    profiles: Sequence[str] = ("mp3",),
+    verify: bool = False,
+    shard: Optional[Tuple[int, int]] = None,
+    merge_dirs: Sequence[str] = (),
+    fetch: bool = False,
+    prefer_mirrors: bool = False,
+    timings_file: Optional[str] = None,
+):
     """
-    Generate the short clips for every good annotation in the dataset.
-    Uses parallel processing to speed up clip generation.
+    Generate the short clips for every good annotation in the dataset, in
+    each of the requested output profiles. A manifest of clips made so far
+    means only missing or stale clips are built, and orphaned clips are
+    removed. Uses parallel processing to speed up clip generation, and can
+    be spread over several machines with --shard, then combined with --merge.
     """
-    # Collect all tasks first
-    tasks = list(iter_annotations())
-    total_tasks = len(tasks)
-    print(f"Found {total_tasks} clips to generate")
+    if merge_dirs:
+        merge_shards(merge_dirs)
+        return
+
+    run_started = datetime.datetime.now().isoformat(timespec="seconds")
+
+    pcm_cache.configure(pcm_cache_mb)
+    profiles = tuple(profiles)
+
+    # Work out what's missing or stale from the manifest alone
+    manifest_file = clip_manifest.manifest_filename(shard)
+    manifest = clip_manifest.load_manifest(manifest_file)
+    if verify:
+        forget_missing(manifest)
+
+    sources = iter_sources()
+    checksums = None
+    if shard is not None:
+        sources = shard_sources(sources, *shard)
+        checksums = {checksum for _, checksum, _, _ in sources}
+
+    tasks, wanted = plan_clips(sources, profiles, manifest)
+    total_clips = sum(len(windows) for _, _, _, windows in tasks)
+    print(f"Found {total_clips} clips to generate from {len(tasks)} samples")
+
+    removed = remove_orphans(manifest, wanted, profiles)
+    if removed:
+        print(f"Removed {removed} orphaned clips")
+
+    if not tasks:
+        clip_manifest.save_manifest(manifest, manifest_file)
+        if clip_manifest.LEGACY_PROFILE in profiles:
+            report_legacy(remove_legacy_clips(manifest, wanted, checksums))
+        return
 
     # Use CPU count - 1 if workers not specified to leave one core free
     if workers is None:
@@ -35,72 +154,456 @@ def make_clips(workers: int = None):
 
     print(f"Using {workers} worker processes")
 
-    # Process in parallel
     completed = 0
-    with ProcessPoolExecutor(max_workers=workers) as executor:
-        # Submit all tasks
-        futures = {
-            executor.submit(make_clip, sample, annotation): (sample, annotation)
-            for sample, annotation in tasks
-        }
+    run_stats = []
+
+    def record(task: ClipTask, future: Future) -> None:
+        nonlocal completed
+        language, checksum, _, windows = task
+        try:
+            made, stats = future.result()
+            for clip_file, md5 in made:
+                manifest[clip_file] = dict(wanted[clip_file], md5=md5)
+
+            run_stats.append(stats)
+
+            completed += len(windows)
+            print(f"Progress: {completed}/{total_clips} clips processed")
+        except Exception as e:
+            print(f"Error processing {checksum}: {str(e)}")
+
+    # Process in parallel, submitting the biggest jobs first so that workers
+    # aren't left waiting on one long decode at the end
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            if fetch:
+                asyncio.run(fetch_and_clip(tasks, executor, record, prefer_mirrors))
+            else:
+                futures = {
+                    executor.submit(make_sample_clips, task): task for task in tasks
+                }
+
+                # Track progress as futures complete
+                for future in as_completed(futures):
+                    record(futures[future], future)
+
+    finally:
+        clip_manifest.save_manifest(manifest, manifest_file)
 
-        # Track progress as futures complete
-        for future in as_completed(futures):
-            sample, annotation = futures[future]
-            try:
-                future.result()  # Check for exceptions
-                completed += 1
-                if completed % 10 == 0 or completed == total_tasks:
-                    print(f"Progress: {completed}/{total_tasks} clips processed")
-            except Exception as e:
-                print(f"Error processing {sample['checksum']}: {str(e)}")
+    # only once their replacements are safely recorded
+    if clip_manifest.LEGACY_PROFILE in profiles:
+        report_legacy(remove_legacy_clips(manifest, wanted, checksums))
 
+    if run_stats:
+        summary = timing.summarize(run_stats)
+        print()
+        timing.print_summary(summary)
 
-def iter_annotations() -> List[Tuple[Dict, Dict]]:
+        if timings_file:
+            summary_record = {
+                "run": run_started,
+                "source_bytes": sum(s["source_bytes"] for s in run_stats),
+                "clips": sum(s["clips"] for s in run_stats),
+                "summary": summary,
+            }
+            timing.write_jsonl(
+                [dict(s, run=run_started) for s in run_stats] + [summary_record],
+                timings_file,
+            )
+
+
+async def fetch_and_clip(
+    tasks: List[ClipTask],
+    executor: Executor,
+    record: Callable[[ClipTask, Future], None],
+    prefer_mirrors: bool = False,
+) -> None:
     """
-    Returns list of (sample, annotation) tuples for all good annotations.
+    Download any missing sources concurrently, handing each one to the clip
+    workers as soon as it arrives, so that network and CPU work overlap.
+    Samples already on disk go straight to the workers.
     """
-    tasks = []
+    loop = asyncio.get_running_loop()
+    downloads = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+    async def run(task: ClipTask) -> None:
+        language, checksum = task[:2]
+        future = loop.create_future()
+        try:
+            fetch_time = None
+            if not os.path.exists(source_filename(language, checksum)):
+                async with downloads:
+                    start = time.perf_counter()
+                    await fetch_source(language, checksum, prefer_mirrors)
+                    fetch_time = time.perf_counter() - start
+
+            made, stats = await loop.run_in_executor(executor, make_sample_clips, task)
+            if fetch_time is not None:
+                stats["stages"]["fetch"] = round(fetch_time, 6)
+
+            future.set_result((made, stats))
+        except Exception as e:
+            future.set_exception(e)
+
+        record(task, future)
+
+    await asyncio.gather(*(run(task) for task in tasks))
+
+
+async def fetch_source(language: str, checksum: str, prefer_mirrors: bool) -> None:
+    "Fetch one sample into samples/, raising DownloadError if it can't be got."
+    with open("index/{0}/{0}-{1}.json".format(language, checksum)) as istream:
+        r = json.load(istream)
+
+    r["dest_file"] = source_filename(language, checksum)
+    await fetch_index.fetch_with_retry(r, prefer_mirrors=prefer_mirrors)
+
+    if not os.path.exists(r["dest_file"]):
+        raise fetch_index.DownloadError("no working media url for " + checksum)
+
+
+def iter_sources() -> Iterator[Source]:
+    """
+    Yield each sample with good annotations, along with their windows,
+    skipping samples whose audio is known to be broken.
+    """
+    broken = mp3scan.broken_checksums()
     for filename in glob.glob("index/*/*.json"):
         with open(filename) as istream:
             sample = json.load(istream)
-            for annotation in sample.get("annotations", []):
-                if annotation["label"] == "good":
-                    tasks.append((sample, annotation))
-    return tasks
+
+        if sample["checksum"] in broken:
+            continue
+
+        windows = tuple(
+            (annotation["offset"], annotation["duration"])
+            for annotation in sample.get("annotations", [])
+            if annotation["label"] == "good"
+        )
+        if windows:
+            yield (
+                sample["language"],
+                sample["checksum"],
+                sample.get("pregain"),
+                windows,
+            )
+
+
+def parse_shard(value: Optional[str]) -> Optional[Tuple[int, int]]:
+    "Parse a shard like 2/4 into a zero-based (shard, n_shards) pair."
+    if value is None:
+        return None
+
+    try:
+        i, n = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise click.BadParameter("expected a shard like 2/4")
+
+    if not 1 <= i <= n:
+        raise click.BadParameter("shard must be between 1 and {0}".format(n))
+
+    return i - 1, n
+
+
+def shard_sources(sources: Iterable[Source], shard: int, n_shards: int) -> List[Source]:
+    """
+    Return the sources belonging to one shard. Samples are hashed by checksum
+    into a fixed set of buckets, and buckets are dealt out to shards heaviest
+    first, so that every machine agrees on the split and gets a similar
+    amount of work.
+    """
+    sources = list(sources)
+    weights = collections.Counter()
+    for source in sources:
+        weights[source_bucket(source[1])] += source_weight(source)
+
+    loads = [0] * n_shards
+    assignment = {}
+    for bucket in sorted(range(SHARD_BUCKETS), key=lambda b: (-weights[b], b)):
+        lightest = min(range(n_shards), key=lambda i: (loads[i], i))
+        assignment[bucket] = lightest
+        loads[lightest] += weights[bucket]
+
+    return [s for s in sources if assignment[source_bucket(s[1])] == shard]
+
+
+def source_bucket(checksum: str) -> int:
+    return int(checksum[:8], 16) % SHARD_BUCKETS
+
+
+def source_weight(source: Source) -> int:
+    "Estimated work in clip-equivalents, using only what's in the index."
+    return DECODE_WEIGHT + len(source[3])
 
 
-def make_clip(sample: Dict, annotation: Dict) -> None:
+def merge_shards(shard_dirs: Sequence[str]) -> None:
     """
-    Generate a single clip from the sample and annotation.
+    Copy clips built on other machines into place and combine their
+    manifests, then remove any clips no longer called for.
     """
-    source_file = "samples/{language}/{language}-{checksum}.mp3".format(
-        language=sample["language"],
-        checksum=sample["checksum"],
+    manifest = clip_manifest.load_manifest()
+    copied = 0
+    for shard_dir in shard_dirs:
+        for manifest_file in sorted(
+            glob.glob(os.path.join(shard_dir, "manifest*.json"))
+        ):
+            for clip_file, entry in clip_manifest.load_manifest(manifest_file).items():
+                if manifest.get(clip_file) == entry:
+                    continue
+
+                source_file = os.path.join(
+                    shard_dir, os.path.relpath(clip_file, clip_manifest.CLIP_DIR)
+                )
+                os.makedirs(os.path.dirname(clip_file), exist_ok=True)
+                shutil.copyfile(source_file, clip_file + ".part")
+                os.replace(clip_file + ".part", clip_file)
+
+                manifest[clip_file] = entry
+                copied += 1
+
+    print(f"Merged {copied} clips from {len(shard_dirs)} shards")
+
+    profiles = sorted(set(entry["profile"] for entry in manifest.values()))
+    _, wanted = plan_clips(iter_sources(), profiles, manifest)
+    removed = remove_orphans(manifest, wanted, profiles)
+    if removed:
+        print(f"Removed {removed} orphaned clips")
+
+    clip_manifest.save_manifest(manifest)
+    if clip_manifest.LEGACY_PROFILE in profiles:
+        report_legacy(remove_legacy_clips(manifest, wanted))
+
+
+def plan_clips(
+    sources: Iterable[Source],
+    profiles: Sequence[str],
+    manifest: clip_manifest.Manifest,
+) -> Tuple[List[ClipTask], Dict[str, clip_manifest.Spec]]:
+    """
+    Returns one task per sample with missing or stale clips, covering all of
+    them, largest first. Also returns the spec of every clip that should
+    exist.
+    """
+    tasks = []
+    wanted = {}
+    for language, checksum, pregain, windows in sources:
+        # analyses are big, so only read one that's changed since its clips
+        # were built
+        stamp = analysis.health_stamp(language, checksum)
+        health = None
+        loaded = False
+
+        to_make = []
+        for offset, duration in windows:
+            stale = []
+            for profile in profiles:
+                clip_file = clip_filename(profile, language, checksum, offset, duration)
+                analysed = clip_manifest.recorded_analysis(
+                    manifest, clip_file, pregain, stamp
+                )
+                if analysed is None:
+                    if not loaded:
+                        health = analysis.load_health(language, checksum)
+                        loaded = True
+
+                    analysed = clip_manifest.analysis_fields(
+                        pregain, health, stamp, offset, duration
+                    )
+
+                spec = clip_manifest.clip_spec(
+                    checksum, offset, duration, pregain, profile, analysed
+                )
+                wanted[clip_file] = spec
+                if not clip_manifest.is_current(manifest, clip_file, spec):
+                    stale.append(profile)
+
+            if stale:
+                to_make.append((offset, duration, tuple(stale)))
+
+        if to_make:
+            tasks.append((language, checksum, pregain, tuple(to_make)))
+
+    tasks.sort(key=estimated_work, reverse=True)
+    return tasks, wanted
+
+
+def remove_orphans(
+    manifest: clip_manifest.Manifest,
+    wanted: Dict[str, clip_manifest.Spec],
+    profiles: Sequence[str],
+) -> int:
+    """
+    Delete clips in the requested profiles that no good annotation calls for
+    any more. Returns the number of clips removed.
+    """
+    orphans = [
+        clip_file
+        for clip_file, entry in manifest.items()
+        if clip_file not in wanted and entry["profile"] in profiles
+    ]
+    for clip_file in orphans:
+        try:
+            os.unlink(clip_file)
+        except FileNotFoundError:
+            pass
+
+        del manifest[clip_file]
+
+    return len(orphans)
+
+
+def remove_legacy_clips(
+    manifest: clip_manifest.Manifest,
+    wanted: Dict[str, clip_manifest.Spec],
+    checksums: Optional[Set[str]] = None,
+) -> int:
+    """
+    Delete clips left in the layout from before profiles, each only once its
+    replacement under the mp3 profile has been built, or once no annotation
+    calls for it. Given checksums, only those samples' clips are touched.
+    Returns the number of clips removed.
+    """
+    removed = []
+    for legacy_file, checksum, replacement in clip_manifest.legacy_clips():
+        if checksums is not None and checksum not in checksums:
+            continue
+
+        if replacement in wanted and not (
+            clip_manifest.is_current(manifest, replacement, wanted[replacement])
+            and os.path.exists(replacement)
+        ):
+            continue
+
+        os.unlink(legacy_file)
+        removed.append(legacy_file)
+
+    for dirname in set(os.path.dirname(f) for f in removed):
+        if not os.listdir(dirname):
+            os.rmdir(dirname)
+
+    return len(removed)
+
+
+def report_legacy(removed: int) -> None:
+    if removed:
+        print(f"Removed {removed} clips in the old layout")
+
+
+def forget_missing(manifest: clip_manifest.Manifest) -> None:
+    "Drop manifest entries whose clips are missing or have been modified."
+    for clip_file, entry in list(manifest.items()):
+        if (
+            not os.path.exists(clip_file)
+            or clip_manifest.file_md5(clip_file) != entry["md5"]
+        ):
+            del manifest[clip_file]
+
+
+def estimated_work(task: ClipTask) -> Tuple[int, int]:
+    "Decoding dominates, so the size of the source file is a good guide."
+    language, checksum, _, windows = task
+    try:
+        size = os.path.getsize(source_filename(language, checksum))
+    except OSError:
+        size = 0
+
+    return size, len(windows)
+
+
+def source_filename(language: str, checksum: str) -> str:
+    return "samples/{language}/{language}-{checksum}.mp3".format(
+        language=language, checksum=checksum
     )
 
-    dest_file = (
-        "samples/_annotated/{language}/{language}-{checksum}-{offset}-{end}.mp3".format(
-            language=sample["language"],
-            checksum=sample["checksum"],
-            offset=annotation["offset"],
-            end=annotation["offset"] + annotation["duration"],
-        )
+
+def clip_filename(
+    profile: str, language: str, checksum: str, offset: float, duration: float
+) -> str:
+    # e.g. samples/_annotated/mp3/fra/fra-8da6ee6728fa1f38c99e16585752ccaa-40-60.mp3
+    return os.path.join(
+        clip_manifest.CLIP_DIR,
+        profile,
+        language,
+        "{language}-{checksum}-{offset}-{end}.{ext}".format(
+            language=language,
+            checksum=checksum,
+            offset=offset,
+            end=offset + duration,
+            ext=audio.PROFILES[profile].extension,
+        ),
     )
 
-    # Skip if already exists
-    if os.path.exists(dest_file):
-        return
 
-    # Ensure parent directory exists
-    parent_dir = os.path.dirname(dest_file)
-    os.makedirs(parent_dir, exist_ok=True)
+def make_sample_clips(task: ClipTask) -> Tuple[List[Tuple[str, str]], Dict]:
+    """
+    Generate the given clips for one sample, decoding the source at most once
+    and encoding each clip to all of its profiles in a single pass. Returns
+    the filename and checksum of each clip made, and timings for each stage.
+    """
+    language, checksum, pregain, windows = task
+
+    to_make = [
+        (
+            offset,
+            duration,
+            [
+                (
+                    audio.PROFILES[profile],
+                    clip_filename(profile, language, checksum, offset, duration),
+                )
+                for profile in profiles
+            ],
+        )
+        for offset, duration, profiles in windows
+    ]
+
+    # Ensure parent directories exist
+    for dirname in set(os.path.dirname(f) for _, _, o in to_make for _, f in o):
+        os.makedirs(dirname, exist_ok=True)
+
+    # Use cached analysis to decide on mono, if the sample has been analysed
+    health = analysis.load_health(language, checksum)
+    gain = analysis.sample_gain(pregain, health)
+
+    timer = timing.StageTimer()
+    source_file = source_filename(language, checksum)
+
+    made = []
+    # decoding, or mapping the sample from the PCM cache, happens here alone
+    with timer("decode"):
+        window = audio.window_loader(source_file)
+
+    for offset, duration, outputs in to_make:
+        with timer("crop"):
+            clip = window(offset, duration)
+
+        with timer("mono_check"):
+            bad_mono = (
+                analysis.is_bad_mono_window(health, offset, duration)
+                if health
+                else audio.is_bad_mono(clip)
+            )
+
+        with timer("gain"):
+            clip = audio.prepared(clip, bad_mono=bad_mono, gain=gain)
+
+        with timer("encode"):
+            audio.encode_clips(clip, outputs)
+
+        with timer("copy"):
+            for _, f in outputs:
+                os.replace(f + ".part", f)
+                made.append((f, clip_manifest.file_md5(f)))
 
-    # Generate clip
-    with audio.cropped(
-        source_file, annotation["offset"], annotation["duration"]
-    ) as temp_file:
-        shutil.copy(temp_file, dest_file)
+    stats = {
+        "language": language,
+        "checksum": checksum,
+        "source_bytes": os.path.getsize(source_file),
+        "clips": len(to_make),
+        "outputs": len(made),
+        "stages": timer.as_dict(),
+    }
+    return made, stats
 
 
 if __name__ == "__main__":
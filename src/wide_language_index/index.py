@@ -9,19 +9,18 @@ Tools for managing the index.
 """
 
 from collections import namedtuple, Counter
-from contextlib import contextmanager
 from os import path
 from urllib.parse import urlparse
 import glob
 import hashlib
 import json
 import shutil
-import tempfile
 
-import jsonschema
 import sh
 import requests
 
+from . import validation
+
 DEFAULT_USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2227.1 Safari/537.36"  # noqa
 HERE = path.abspath(path.dirname(__file__))
 INDEX_DIR = path.join(HERE, "../index")
@@ -30,7 +29,8 @@ SAMPLE_DIR = path.join(HERE, "../samples")
 SUPPORTED_FORMATS = set(["mp3", "m4a"])
 
 
-StagedFile = namedtuple("StagedFile", "filename checksum orig_checksum")
+# fingerprint is the probe fingerprint of the file as downloaded
+StagedFile = namedtuple("StagedFile", "filename checksum orig_checksum fingerprint")
 
 
 class DownloadError(Exception):
@@ -41,26 +41,19 @@ class CodecError(Exception):
     pass
 
 
-def stage_audio(url, language, user_agent=DEFAULT_USER_AGENT, method="wget"):
-    "Fetch audio and stage it in the samples/ directory."
-
+def check_audio_type(url):
+    "Return the type of audio at the url, raising CodecError if unsupported."
     audio_type = _detect_audio_type(url)
     if audio_type not in SUPPORTED_FORMATS:
         raise CodecError(
             "{0} not a supported codec, from url {1}".format(audio_type, url)
         )
 
-    with downloaded(url, "." + audio_type, method=method) as filename:
-        if audio_type == "mp3":
-            return _staged_file(filename, language)
-
-        with transcoded_to_mp3(filename) as transcoded:
-            return _staged_file(
-                transcoded, language, orig_checksum=md5_checksum(filename)
-            )
+    return audio_type
 
 
-def _staged_file(source_file, language, orig_checksum=None):
+def stage_file(source_file, language, orig_checksum=None, fingerprint=None, move=False):
+    "Put an mp3 in the samples/ directory under its checksum."
     checksum = md5_checksum(source_file)
     dest_file = path.join(
         SAMPLE_DIR,
@@ -70,43 +63,39 @@ def _staged_file(source_file, language, orig_checksum=None):
     )
     directory = path.dirname(dest_file)
     sh.mkdir("-p", directory)
-    shutil.copy(source_file, dest_file)
+    if move:
+        shutil.move(source_file, dest_file)
+    else:
+        shutil.copy(source_file, dest_file)
 
-    return StagedFile(dest_file, checksum, orig_checksum)
+    return StagedFile(dest_file, checksum, orig_checksum, fingerprint)
 
 
-@contextmanager
-def downloaded(url, suffix, method="wget"):
+def download(url, filename, method="wget"):
     print("      downloading {0}".format(url))
-    with tempfile.NamedTemporaryFile(suffix=suffix) as t:
-        if method == "wget":
-            try:
-                sh.wget("-e", "robots=off", "-U", DEFAULT_USER_AGENT, "-O", t.name, url)
-            except sh.ErrorReturnCode_8:
-                raise DownloadError(url)
+    if method == "wget":
+        try:
+            sh.wget("-e", "robots=off", "-U", DEFAULT_USER_AGENT, "-O", filename, url)
+        except sh.ErrorReturnCode_8:
+            raise DownloadError(url)
 
-        elif method == "requests":
-            resp = requests.get(url)
-            if not resp.status_code == 200:
-                raise DownloadError(url)
+    elif method == "requests":
+        resp = requests.get(url)
+        if not resp.status_code == 200:
+            raise DownloadError(url)
 
-            with open(t.name, "wb") as ostream:
-                ostream.write(resp.content)
+        with open(filename, "wb") as ostream:
+            ostream.write(resp.content)
 
-        else:
-            raise ValueError("unsupported method {0}".format(method))
+    else:
+        raise ValueError("unsupported method {0}".format(method))
 
-        yield t.name
 
-
-@contextmanager
-def transcoded_to_mp3(source_file):
+def transcode_to_mp3(source_file, dest_file):
     print("   transcoding to mp3...")
-    with tempfile.NamedTemporaryFile(suffix=".mp3") as t:
-        cmd = ["-i", source_file, "-c:a", "libmp3lame", "-ab", "256k", "-y", t.name]
-        print("   ffmpeg {0}".format(" ".join(cmd)))
-        sh.ffmpeg(*cmd)
-        yield t.name
+    cmd = ["-i", source_file, "-c:a", "libmp3lame", "-ab", "256k", "-y", dest_file]
+    print("   ffmpeg {0}".format(" ".join(cmd)))
+    sh.ffmpeg(*cmd)
 
 
 def _detect_audio_type(url):
@@ -149,15 +138,8 @@ def md5_checksum(filename):
         return hashlib.md5(istream.read()).hexdigest()
 
 
-def load_schema():
-    filename = path.join(INDEX_DIR, "schema.json")
-    with open(filename) as istream:
-        return json.load(istream)
-
-
-def save(sample, schema=None):
-    schema = schema or load_schema()
-    jsonschema.validate(sample, schema)
+def save(sample):
+    validation.validate_sample(sample)
     filename = path.join(
         INDEX_DIR, "{language}/{language}-{checksum}.json".format(**sample)
     )
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+#
+#  ingest.py
+#  wide-language-index
+#
+
+"""
+Stage new audio in the samples/ directory as a pipeline: posts are probed
+and downloaded several at a time, then transcoded by a pool sized to the
+CPUs, then hashed and moved into place. Each stage has its own bounded queue,
+so a slow transcode never holds up downloads.
+
+Finished posts come back to the caller in the order they finish, so that
+saving records, and deciding when a language has enough, stays on one
+thread.
+"""
+
+import collections
+import os
+import queue
+import tempfile
+import threading
+from typing import Dict, List, Optional, Set
+
+from . import index, probe
+
+DOWNLOAD_WORKERS = 4
+MAX_IN_FLIGHT = 16
+
+TOMBSTONE = None
+
+
+class Job(object):
+    "A post on its way into samples/, and what became of it."
+
+    def __init__(self, sample: Dict, audio_type: str):
+        self.sample = sample
+        self.language = sample["language"]
+        (self.media_url,) = sample["media_urls"]
+        self.audio_type = audio_type
+
+        self.probed: Optional[probe.Probe] = None
+        # an existing sample with the same audio, found before downloading
+        self.duplicate: Optional[str] = None
+        self.download_file: Optional[str] = None
+        self.orig_checksum: Optional[str] = None
+        self.fingerprint: Optional[str] = None
+        self.mp3_file: Optional[str] = None
+
+        self.staged: Optional[index.StagedFile] = None
+        self.error: Optional[Exception] = None
+
+
+class IngestPipeline(object):
+    """
+    Download, transcode and stage posts concurrently. Submit posts with
+    submit(), making room with next_done() whenever full() says so, and
+    collect the remainder with drain(). Posts never collected, say after an
+    error, have their staged audio removed on close(), since they'll have no
+    record in the index.
+    """
+
+    def __init__(
+        self,
+        seen: Set[str],
+        probes: probe.ProbeIndex,
+        user_agent: str = index.DEFAULT_USER_AGENT,
+        download_workers: int = DOWNLOAD_WORKERS,
+        transcode_workers: Optional[int] = None,
+        max_in_flight: int = MAX_IN_FLIGHT,
+    ):
+        # only read here, to skip downloads of audio already in the index
+        self.seen = seen
+        self.probes = probes
+        self.user_agent = user_agent
+        self.max_in_flight = max_in_flight
+
+        # every job in flight fits in any queue, so no stage blocks on another
+        self.to_download: queue.Queue = queue.Queue(maxsize=max_in_flight)
+        self.to_transcode: queue.Queue = queue.Queue(maxsize=max_in_flight)
+        self.to_store: queue.Queue = queue.Queue(maxsize=max_in_flight)
+        self.done: queue.Queue = queue.Queue()
+
+        self.in_flight = collections.Counter()
+        self.n_in_flight = 0
+
+        self.workers: List[threading.Thread] = []
+        self.stages = [
+            (self.to_download, self._download, download_workers),
+            (
+                self.to_transcode,
+                self._transcode,
+                transcode_workers or os.cpu_count() or 1,
+            ),
+            # one mover, since moves are cheap and hashing is disk-bound
+            (self.to_store, self._store, 1),
+        ]
+        for q, work, n in self.stages:
+            for _ in range(n):
+                t = threading.Thread(target=self._run, args=(q, work), daemon=True)
+                t.start()
+                self.workers.append(t)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def full(self) -> bool:
+        return self.n_in_flight >= self.max_in_flight
+
+    def submit(self, sample: Dict) -> None:
+        "Start a post on its way. Raise CodecError for unsupported audio."
+        (media_url,) = sample["media_urls"]
+        job = Job(sample, index.check_audio_type(media_url))
+
+        self.in_flight[job.language] += 1
+        self.n_in_flight += 1
+        self.to_download.put(job)
+
+    def next_done(self) -> Job:
+        "Wait for the next post to finish, successfully or not."
+        job = self.done.get()
+        self.in_flight[job.language] -= 1
+        self.n_in_flight -= 1
+        return job
+
+    def drain(self):
+        while self.n_in_flight:
+            yield self.next_done()
+
+    def close(self) -> None:
+        # let anything still in flight finish, so no temp files are left
+        for job in self.drain():
+            self._unstage(job)
+
+        for q, _, n in self.stages:
+            for _ in range(n):
+                q.put(TOMBSTONE)
+
+        for t in self.workers:
+            t.join()
+
+    def _unstage(self, job: Job) -> None:
+        "Remove audio staged for a post that won't be saved."
+        # the same audio may already belong to a sample in the index
+        if job.staged is not None and job.staged.checksum not in self.seen:
+            if os.path.exists(job.staged.filename):
+                os.remove(job.staged.filename)
+
+        job.staged = None
+
+    def _run(self, q: queue.Queue, work) -> None:
+        while True:
+            job = q.get()
+            if job is TOMBSTONE:
+                return
+
+            try:
+                next_q = work(job)
+            except Exception as e:
+                # any failure ends the job, but never the worker
+                job.error = e
+                next_q = self.done
+
+            if next_q is self.done:
+                _cleanup(job)
+
+            next_q.put(job)
+
+    def _download(self, job: Job) -> queue.Queue:
+        # a cheap look at the file first, since feeds often re-publish old audio
+        job.probed = probe.probe_url(job.media_url, self.probes, self.user_agent)
+        duplicate = self.probes.find(job.probed)
+        if duplicate is not None and duplicate in self.seen:
+            job.duplicate = duplicate
+            return self.done
+
+        job.download_file = _temp_file("." + job.audio_type)
+        index.download(job.media_url, job.download_file)
+        job.fingerprint = probe.file_fingerprint(job.download_file)
+
+        if job.audio_type == "mp3":
+            job.mp3_file = job.download_file
+            job.download_file = None
+            return self.to_store
+
+        job.orig_checksum = index.md5_checksum(job.download_file)
+        return self.to_transcode
+
+    def _transcode(self, job: Job) -> queue.Queue:
+        job.mp3_file = _temp_file(".mp3")
+        index.transcode_to_mp3(job.download_file, job.mp3_file)
+        return self.to_store
+
+    def _store(self, job: Job) -> queue.Queue:
+        job.staged = index.stage_file(
+            job.mp3_file,
+            job.language,
+            orig_checksum=job.orig_checksum,
+            fingerprint=job.fingerprint,
+            move=True,
+        )
+        job.mp3_file = None
+        return self.done
+
+
+def _temp_file(suffix: str) -> str:
+    fd, filename = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    return filename
+
+
+def _cleanup(job: Job) -> None:
+    for filename in (job.download_file, job.mp3_file):
+        if filename is not None and os.path.exists(filename):
+            os.remove(filename)
+
+    job.download_file = job.mp3_file = None
@@ -15,7 +15,6 @@ import sys
 from os import getenv, path
 from typing import Any, Dict, List
 
-import boto3
 import click
 from dotenv import load_dotenv
 
@@ -43,6 +42,9 @@ def get_s3_client():
     """
     Create an S3 client using credentials from environment variables.
     """
+    # boto3 is slow to import, so only pay for it when we need it
+    import boto3
+
     return boto3.client(
         "s3",
         aws_access_key_id=getenv("AWS_ACCESS_KEY_ID"),
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  mp3scan.py
+#  wide-language-index
+#
+
+"""
+Check the structure of MP3 files by walking their frame headers, without
+decoding any audio. This catches truncated downloads, corrupt streams and
+trailing garbage that an MD5 match alone can't, before they trip up decoding
+during annotation or clip generation.
+"""
+
+import glob
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+from typing import Any, Dict, List, Optional, Set
+
+import click
+
+SCAN_FILE = ".cache/mp3scan.json"
+
+# bump this whenever the scan changes in a way that should redo every file
+SCAN_VERSION = 2
+
+# problems that make a sample unusable; anything else is only a warning
+BROKEN = {"no_frames", "bad_sync", "mixed_sample_rates", "truncated"}
+
+# a stream is only truncated if its Xing, Info or VBRI header promises more
+# than this fraction of frames beyond what's there; a last frame cut short
+# is common, decodes fine, and is only a warning
+TRUNCATED_FRACTION = 0.05
+
+CHUNK_SIZE = 16
+
+# kbps, indexed by [mpeg1][layer][bitrate index]
+BITRATES = {
+    True: {
+        1: [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+        2: [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+        3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    },
+    False: {
+        1: [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+        2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+        3: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    },
+}
+
+# Hz, indexed by [version bits][sample rate index]
+SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG 1
+    2: [22050, 24000, 16000],  # MPEG 2
+    0: [11025, 12000, 8000],  # MPEG 2.5
+}
+
+Scan = Dict[str, Any]
+
+
+@click.command()
+@click.option("--workers", default=None, type=int, help="Number of worker processes")
+@click.option("--language", help="Only scan the given language.")
+@click.option("--force", is_flag=True, help="Re-scan samples with cached results.")
+def scan_samples(
+    workers: Optional[int] = None,
+    language: Optional[str] = None,
+    force: bool = False,
+):
+    """
+    Walk the frames of every sample in samples/, reporting any that are
+    truncated or corrupt, and record the results for the samplers.
+    """
+    results = load_scans()
+
+    pattern = "samples/{0}/*.mp3".format(language or "*")
+    to_scan = []
+    for filename in sorted(glob.glob(pattern)):
+        lang, checksum = _parse_sample_filename(filename)
+        if lang.startswith("_"):
+            continue
+
+        cached = results.get(checksum)
+        if force or cached is None or cached.get("version") != SCAN_VERSION:
+            to_scan.append(filename)
+
+    print(f"Found {len(to_scan)} samples to scan")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        scans = executor.map(scan_file, to_scan, chunksize=CHUNK_SIZE)
+        for filename, scan in zip(to_scan, scans):
+            results[_parse_sample_filename(filename)[1]] = scan
+            if scan["problems"]:
+                print("{0}: {1}".format(filename, ", ".join(scan["problems"])))
+
+    save_scans(results)
+
+    n_broken = sum(is_broken(s) for s in results.values())
+    print(f"{len(results)} samples scanned, {n_broken} broken")
+    if n_broken:
+        sys.exit(1)
+
+
+def scan_file(filename: str) -> Scan:
+    with open(filename, "rb") as istream:
+        return scan_bytes(istream.read())
+
+
+def scan_bytes(data: bytes) -> Scan:
+    """
+    Walk the MP3 frames in data. A stream is expected to be an optional ID3v2
+    tag, then back-to-back frames, then optional ID3v1 or APE tags.
+    """
+    end = len(data)
+    if end >= 128 and data[end - 128 : end - 125] == b"TAG":
+        end -= 128
+
+    pos = min(_id3v2_size(data), end)
+
+    frames = 0
+    samples_by_rate: Dict[int, int] = {}
+    resyncs = 0
+    skipped = 0
+    short_last_frame = False
+
+    # tolerate padding between the ID3 tag and the first frame
+    start = _find_frame(data, pos, end)
+    leading = (start if start is not None else end) - pos
+    pos = start if start is not None else end
+    expected_frames = _expected_frames(data, pos, end)
+
+    while pos + 4 <= end:
+        header = _parse_header(data, pos)
+        if header is None:
+            nxt = _find_frame(data, pos + 1, end)
+            if nxt is None:
+                break
+
+            resyncs += 1
+            skipped += nxt - pos
+            pos = nxt
+            continue
+
+        length, rate, n_samples = header
+        if pos + length > end:
+            short_last_frame = True
+            pos = end
+            break
+
+        frames += 1
+        samples_by_rate[rate] = samples_by_rate.get(rate, 0) + n_samples
+        pos += length
+
+    tail = data[pos:end]
+    garbage = len(tail) > 0 and not _is_known_tail(tail)
+
+    problems = []
+    if frames == 0:
+        problems.append("no_frames")
+    if resyncs:
+        problems.append("bad_sync")
+    if len(samples_by_rate) > 1:
+        problems.append("mixed_sample_rates")
+    if expected_frames and frames < expected_frames * (1 - TRUNCATED_FRACTION):
+        problems.append("truncated")
+    elif short_last_frame:
+        problems.append("short_last_frame")
+    if garbage:
+        problems.append("garbage_tail")
+
+    return {
+        "version": SCAN_VERSION,
+        "size": len(data),
+        "frames": frames,
+        "expected_frames": expected_frames,
+        "duration": round(sum(n / r for r, n in samples_by_rate.items()), 3),
+        "sample_rates": sorted(samples_by_rate),
+        "leading_bytes": leading,
+        "resyncs": resyncs,
+        "skipped_bytes": skipped,
+        "tail_bytes": len(tail) if garbage else 0,
+        "problems": problems,
+    }
+
+
+def _parse_sample_filename(filename: str):
+    # like analysis.parse_sample_filename, which would cost audit its lazy
+    # numpy import
+    language = path.basename(path.dirname(filename))
+    checksum = path.splitext(path.basename(filename))[0].split("-")[-1]
+    return language, checksum
+
+
+def _id3v2_size(data: bytes) -> int:
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+
+    # a syncsafe integer, seven bits per byte
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    has_footer = data[5] & 0x10
+    return 10 + size + (10 if has_footer else 0)
+
+
+def _parse_header(data: bytes, pos: int):
+    "Return the (length, sample rate, samples) of the frame at pos, or None."
+    b1 = data[pos + 1]
+    if data[pos] != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+
+    version = (b1 >> 3) & 3
+    layer = 4 - ((b1 >> 1) & 3)
+    b2 = data[pos + 2]
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 3
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = BITRATES[mpeg1][layer][bitrate_index] * 1000
+    rate = SAMPLE_RATES[version][rate_index]
+    padding = (b2 >> 1) & 1
+
+    if layer == 1:
+        return (12 * bitrate // rate + padding) * 4, rate, 384
+
+    if layer == 3 and not mpeg1:
+        return 72 * bitrate // rate + padding, rate, 576
+
+    return 144 * bitrate // rate + padding, rate, 1152
+
+
+def _expected_frames(data: bytes, pos: int, end: int) -> Optional[int]:
+    "The frame count promised by a VBR header in the frame at pos, if any."
+    header = _parse_header(data, pos) if pos + 4 <= end else None
+    if header is None:
+        return None
+
+    frame = data[pos : min(pos + header[0], end)]
+
+    # Xing (VBR) or Info (CBR) follows the side information
+    for tag in (b"Xing", b"Info"):
+        i = frame.find(tag, 4, 40)
+        if i >= 0 and i + 12 <= len(frame):
+            flags = int.from_bytes(frame[i + 4 : i + 8], "big")
+            if flags & 1:
+                return int.from_bytes(frame[i + 8 : i + 12], "big")
+
+            return None
+
+    # VBRI sits at a fixed place, with its frame count after the byte count
+    if frame[36:40] == b"VBRI" and len(frame) >= 54:
+        return int.from_bytes(frame[50:54], "big")
+
+    return None
+
+
+def _find_frame(data: bytes, pos: int, end: int) -> Optional[int]:
+    """
+    Find the next frame at or after pos, requiring the frame after it to
+    line up too so that stray 0xFF bytes aren't mistaken for a frame.
+    """
+    while True:
+        pos = data.find(b"\xff", pos, end)
+        if pos < 0 or pos + 4 > end:
+            return None
+
+        header = _parse_header(data, pos)
+        if header is not None:
+            nxt = pos + header[0]
+            if nxt + 4 > end or _parse_header(data, nxt) is not None:
+                return pos
+
+        pos += 1
+
+
+def _is_known_tail(tail: bytes) -> bool:
+    return (
+        tail.startswith(b"APETAGEX")
+        or tail.startswith(b"LYRICSBEGIN")
+        or tail.count(0) == len(tail)
+    )
+
+
+def is_broken(scan: Optional[Scan]) -> bool:
+    return scan is not None and bool(BROKEN.intersection(scan["problems"]))
+
+
+def broken_checksums(scans: Optional[Dict[str, Scan]] = None) -> Set[str]:
+    "The checksums of samples known to be broken."
+    if scans is None:
+        scans = load_scans()
+
+    return {checksum for checksum, scan in scans.items() if is_broken(scan)}
+
+
+def load_scans() -> Dict[str, Scan]:
+    if not path.exists(SCAN_FILE):
+        return {}
+
+    with open(SCAN_FILE) as istream:
+        return json.load(istream)
+
+
+def save_scans(scans: Dict[str, Scan]) -> None:
+    os.makedirs(path.dirname(SCAN_FILE), exist_ok=True)
+
+    # write atomically, so an interrupted run never loses earlier results
+    tmp_file = SCAN_FILE + ".tmp"
+    with open(tmp_file, "w") as ostream:
+        json.dump(scans, ostream, indent=2, sort_keys=True)
+    os.replace(tmp_file, SCAN_FILE)
+
+
+def describe(scan: Scan) -> List[str]:
+    "Explain a scan's problems in words."
+    explanations = {
+        "no_frames": "no MP3 frames found",
+        "bad_sync": "lost frame sync {0} times, skipping {1} bytes".format(
+            scan["resyncs"], scan["skipped_bytes"]
+        ),
+        "mixed_sample_rates": "mixes sample rates {0}".format(
+            ", ".join(str(r) for r in scan["sample_rates"])
+        ),
+        "truncated": "only {0} of {1} frames are present".format(
+            scan["frames"], scan["expected_frames"]
+        ),
+        "short_last_frame": "the last frame is cut short",
+        "garbage_tail": "{0} bytes of garbage after the last frame".format(
+            scan["tail_bytes"]
+        ),
+    }
+    return [explanations[p] for p in scan["problems"]]
+
+
+if __name__ == "__main__":
+    scan_samples()
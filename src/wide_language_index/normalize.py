@@ -9,29 +9,108 @@ Reformat every JSON record so that they're all formatted consistently.
 """
 
 import glob
+import hashlib
 import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+from typing import Dict, Iterable, Optional, Tuple
 
 import click
 
+# the hash of each file when it was last found in canonical form
+CACHE_FILE = ".cache/normalize.json"
+
+# below this many files, starting worker processes costs more than it saves
+PARALLEL_MIN_FILES = 200
+CHUNK_SIZE = 32
+
 
 @click.command()
-def normalize_json_files():
+@click.option(
+    "--check",
+    is_flag=True,
+    help="Report files that aren't normalized, without changing them.",
+)
+@click.option("--workers", type=int, help="Number of worker processes.")
+def normalize_json_files(check=False, workers=None):
     """
     Make sure all JSON is identically formatted.
     """
+    start = time.perf_counter()
+
     json_files = []
     json_files.extend(glob.glob("data/*.json"))
     json_files.extend(glob.glob("ext/*.json"))
     json_files.extend(glob.glob("index/*/*.json"))
 
-    n = 0
-    for f in json_files:
-        n += normalize_file(f)
+    cache = load_cache()
 
-    print(n, "records changed")
+    # files already known to be canonical need hashing, but not parsing
+    to_check = []
+    for f in sorted(json_files):
+        with open(f, "rb") as istream:
+            digest = hashlib.md5(istream.read()).hexdigest()
 
+        if cache.get(f) != digest:
+            to_check.append(f)
 
-def normalize_file(f):
+    # forget files that have since been removed
+    present = set(json_files)
+    new_cache = {f: h for f, h in cache.items() if f in present}
+
+    n = 0
+    for f, changed, digest in normalize_all(to_check, check, workers):
+        n += changed
+        if changed:
+            print(f)
+
+        if digest is not None:
+            new_cache[f] = digest
+        else:
+            new_cache.pop(f, None)
+
+    save_cache(new_cache)
+
+    print(
+        "{0} records {1}, {2} checked, {3} unchanged since last time ({4:.2f}s)".format(
+            n,
+            "not normalized" if check else "changed",
+            len(to_check),
+            len(json_files) - len(to_check),
+            time.perf_counter() - start,
+        )
+    )
+
+    if check and n:
+        sys.exit(1)
+
+
+def normalize_all(
+    files: Iterable[str], check: bool = False, workers: Optional[int] = None
+) -> Iterable[Tuple[str, bool, Optional[str]]]:
+    "Normalize files in parallel, yielding (file, changed, canonical hash)."
+    files = list(files)
+    if len(files) < PARALLEL_MIN_FILES or workers == 1:
+        for f in files:
+            yield (f, *normalize_file(f, check))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        checks = [check] * len(files)
+        results = executor.map(normalize_file, files, checks, chunksize=CHUNK_SIZE)
+        for f, (changed, digest) in zip(files, results):
+            yield f, changed, digest
+
+
+def normalize_file(f, check=False):
+    """
+    Rewrite the file in canonical form, or with check just compare against
+    it. Return whether it differed, and the hash of its canonical form if
+    the file now holds it.
+    """
     s = open(f).read()
     data = json.loads(s)
 
@@ -42,15 +121,18 @@ def normalize_file(f):
     #     data.sort(key=lambda r: r["language"])
 
     s_norm = json.dumps(data, indent=2, sort_keys=True, ensure_ascii=False)
+    digest = hashlib.md5(s_norm.encode("utf8")).hexdigest()
 
     if s != s_norm:
-        print(f)
+        if check:
+            return True, None
+
         with open(f, "w") as ostream:
             ostream.write(s_norm)
 
-        return True
+        return True, digest
 
-    return False
+    return False, digest
 
 
 def remove_duplicates(xs):
@@ -64,5 +146,22 @@ def remove_duplicates(xs):
     return ys
 
 
+def load_cache() -> Dict[str, str]:
+    try:
+        with open(CACHE_FILE) as istream:
+            return json.load(istream)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache: Dict[str, str]) -> None:
+    os.makedirs(path.dirname(CACHE_FILE), exist_ok=True)
+
+    tmp_file = CACHE_FILE + ".tmp"
+    with open(tmp_file, "w") as ostream:
+        json.dump(cache, ostream, indent=2, sort_keys=True)
+    os.replace(tmp_file, CACHE_FILE)
+
+
 if __name__ == "__main__":
     normalize_json_files()
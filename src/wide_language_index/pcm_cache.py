@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+#
+#  pcm_cache.py
+#  wide-language-index
+#
+
+"""
+An optional on-disk cache of decoded PCM audio. Each sample is decoded once to
+a raw .npy file, which is then memory-mapped so that any window can be served
+as a slice without decoding the MP3 again. The cache is bounded in size and
+evicts the least recently used samples first.
+"""
+
+import json
+import os
+from collections import namedtuple
+from os import path
+from typing import Optional
+
+import numpy as np
+import pydub
+
+from . import audio
+
+PCM_CACHE_DIR = ".cache/pcm"
+
+# the cache is enabled by setting a size limit, so that worker processes
+# inherit the setting
+PCM_CACHE_ENV = "PCM_CACHE_MB"
+
+Pcm = namedtuple("Pcm", "frames frame_rate sample_width")
+
+
+class PcmCache(object):
+    def __init__(self, max_bytes: int, cache_dir: str = PCM_CACHE_DIR):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+
+    def load(self, mp3_file: str) -> Pcm:
+        """
+        Return a memory-mapped (frames, channels) array for the sample,
+        decoding it on a miss.
+        """
+        data_file, meta_file = self.filenames(mp3_file)
+
+        # another process may evict the sample at any moment, even mid-load,
+        # but once mapped it stays readable
+        try:
+            # touching the file is what keeps it recently used
+            os.utime(data_file)
+            with open(meta_file) as istream:
+                meta = json.load(istream)
+
+            frames = np.load(data_file, mmap_mode="r")
+        except OSError:
+            return self.store(mp3_file)
+
+        return Pcm(frames, meta["frame_rate"], meta["sample_width"])
+
+    def window(self, mp3_file: str, offset: float, duration: float):
+        "Return the given window of the sample as an AudioSegment."
+        return cut_window(self.load(mp3_file), offset, duration)
+
+    def store(self, mp3_file: str) -> Pcm:
+        "Decode the sample into the cache, returning its frames in memory."
+        segment = pydub.AudioSegment.from_mp3(mp3_file)
+        frames = audio.pcm_array(segment)
+        data_file, meta_file = self.filenames(mp3_file)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # write atomically, since several workers may share the cache
+        suffix = ".tmp{0}".format(os.getpid())
+        with open(data_file + suffix, "wb") as ostream:
+            np.save(ostream, frames)
+
+        with open(meta_file + suffix, "w") as ostream:
+            json.dump(
+                {
+                    "frame_rate": segment.frame_rate,
+                    "sample_width": segment.sample_width,
+                },
+                ostream,
+            )
+
+        os.replace(meta_file + suffix, meta_file)
+        os.replace(data_file + suffix, data_file)
+
+        self.evict(keep=data_file)
+
+        return Pcm(frames, segment.frame_rate, segment.sample_width)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        "Drop the least recently used samples until the cache fits its limit."
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npy"):
+                f = path.join(self.cache_dir, name)
+                try:
+                    st = os.stat(f)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, f))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, f in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            if f == keep:
+                continue
+
+            for stale in (f, f[: -len(".npy")] + ".json"):
+                try:
+                    os.unlink(stale)
+                except FileNotFoundError:
+                    pass
+
+            total -= size
+
+    def filenames(self, mp3_file: str):
+        # e.g. .cache/pcm/fra-8da6ee6728fa1f38c99e16585752ccaa.npy
+        stem = path.splitext(path.basename(mp3_file))[0]
+        base = path.join(self.cache_dir, stem)
+        return base + ".npy", base + ".json"
+
+
+def cut_window(pcm: Pcm, offset: float, duration: float) -> pydub.AudioSegment:
+    "Cut a window from loaded frames, as an AudioSegment."
+    start = int(offset * pcm.frame_rate)
+    end = int((offset + duration) * pcm.frame_rate)
+    frames = pcm.frames[start:end]
+
+    # a view of the mapped file, so the window is never copied; an empty
+    # window can't be viewed as bytes, but is empty like an uncached one
+    data = memoryview(frames).cast("B") if frames.size else b""
+    return pydub.AudioSegment(
+        data=data,
+        sample_width=pcm.sample_width,
+        frame_rate=pcm.frame_rate,
+        channels=frames.shape[1],
+    )
+
+
+def configure(max_mb: Optional[int]) -> None:
+    "Enable the cache for this process and any workers it starts."
+    if max_mb:
+        os.environ[PCM_CACHE_ENV] = str(max_mb)
+
+
+def default_cache() -> Optional[PcmCache]:
+    "Return the configured cache, or None if it's disabled."
+    max_mb = os.environ.get(PCM_CACHE_ENV)
+    if not max_mb:
+        return None
+
+    return PcmCache(int(max_mb) * 2**20)
@@ -5,9 +5,11 @@
 #  wide-language-index
 #
 
+import json
+
 import click
 
-from . import audio
+from . import analysis, audio, playback
 
 
 @click.command()
@@ -27,8 +29,34 @@ def play_offset(path, offset, duration):
     Play only part of the given mp3 file. Return True if the whole clip
     played.
     """
-    with audio.cropped(path, offset, duration) as clip:
-        return audio.play_mp3(clip)
+    language, checksum = analysis.parse_sample_filename(path)
+    health = analysis.load_health(language, checksum)
+    gain = analysis.sample_gain(load_pregain(language, checksum), health)
+    if health is None:
+        # not analyzed yet, so measure just this window before playing it
+        clip = audio.prepared(audio.load_window(path, offset, duration), gain=gain)
+        return playback.play_segment(clip)
+
+    return playback.play(
+        audio.stream_window(
+            path,
+            offset,
+            duration,
+            health["frame_rate"],
+            health["channels"],
+            bad_mono=analysis.is_bad_mono_window(health, offset, duration),
+            gain=gain,
+        )
+    )
+
+
+def load_pregain(language, checksum):
+    "The gain recorded in the sample's index record, if it has one."
+    try:
+        with open("index/{0}/{0}-{1}.json".format(language, checksum)) as istream:
+            return json.load(istream).get("pregain")
+    except (OSError, ValueError):
+        return None
 
 
 if __name__ == "__main__":
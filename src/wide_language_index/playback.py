@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+#  playback.py
+#  wide-language-index
+#
+
+"""
+Play audio by streaming raw PCM to a player process, so that playback starts
+with the first chunk and no intermediate file is written. The player is
+chosen with the WLI_PLAYER environment variable, or else the first one found
+on the path.
+"""
+
+import os
+import shutil
+import subprocess
+import threading
+from typing import Iterable, Iterator, List, Optional
+
+import pydub
+
+PLAYER_ENV = "WLI_PLAYER"
+
+# tried in this order when no player is configured
+PLAYER_ORDER = ["pacat", "aplay", "play"]
+
+CHUNK_S = 0.5
+
+MS_PER_S = 1000
+
+
+class PlaybackError(Exception):
+    pass
+
+
+def pacat_command(frame_rate: int, channels: int, sample_width: int) -> List[str]:
+    "PulseAudio or PipeWire."
+    formats = {2: "s16le", 4: "s32le"}
+    return [
+        "pacat",
+        "--playback",
+        "--raw",
+        "--format={0}".format(_format(formats, sample_width)),
+        "--rate={0}".format(frame_rate),
+        "--channels={0}".format(channels),
+    ]
+
+
+def aplay_command(frame_rate: int, channels: int, sample_width: int) -> List[str]:
+    "Plain ALSA."
+    formats = {1: "S8", 2: "S16_LE", 4: "S32_LE"}
+    return [
+        "aplay",
+        "-q",
+        "-t",
+        "raw",
+        "-f",
+        _format(formats, sample_width),
+        "-r",
+        str(frame_rate),
+        "-c",
+        str(channels),
+        "-",
+    ]
+
+
+def play_command(frame_rate: int, channels: int, sample_width: int) -> List[str]:
+    "SoX, which also works on macOS."
+    return [
+        "play",
+        "-q",
+        "-t",
+        "raw",
+        "-e",
+        "signed",
+        "-b",
+        str(8 * sample_width),
+        "-r",
+        str(frame_rate),
+        "-c",
+        str(channels),
+        "-",
+    ]
+
+
+def _format(formats, sample_width):
+    if sample_width not in formats:
+        raise PlaybackError("unsupported sample width: {0}".format(sample_width))
+
+    return formats[sample_width]
+
+
+PLAYERS = {
+    "pacat": pacat_command,
+    "aplay": aplay_command,
+    "play": play_command,
+    # discards the audio, for headless use and testing
+    "null": None,
+}
+
+
+def choose_player(name: Optional[str] = None) -> str:
+    "The configured player, or else the first one we can find."
+    name = name or os.environ.get(PLAYER_ENV)
+    if name:
+        if name not in PLAYERS:
+            raise PlaybackError(
+                "unknown player {0}, expected one of: {1}".format(
+                    name, ", ".join(sorted(PLAYERS))
+                )
+            )
+        return name
+
+    for name in PLAYER_ORDER:
+        if shutil.which(name):
+            return name
+
+    raise PlaybackError(
+        "no audio player found, install one of {0} or set {1}".format(
+            ", ".join(PLAYER_ORDER), PLAYER_ENV
+        )
+    )
+
+
+def play(
+    chunks: Iterable[pydub.AudioSegment],
+    player: Optional[str] = None,
+    stop: Optional[threading.Event] = None,
+) -> bool:
+    """
+    Stream chunks of audio to the player as they're produced. The player is
+    started on the first chunk, which sets the format for the rest. Return
+    False if playback was cancelled by setting `stop` or by the player
+    exiting. Ctrl-C only cuts the clip short, so it still returns True.
+    """
+    name = choose_player(player)
+    p = None
+
+    print("<playing...", end="", flush=True)
+    try:
+        for chunk in chunks:
+            if stop is not None and stop.is_set():
+                break
+
+            if p is None and PLAYERS[name] is not None:
+                cmd = PLAYERS[name](
+                    chunk.frame_rate, chunk.channels, chunk.sample_width
+                )
+                p = subprocess.Popen(
+                    cmd,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+
+            if p is not None:
+                p.stdin.write(chunk.raw_data)
+
+        else:
+            if p is not None:
+                p.stdin.close()
+                p.wait()
+            print("done>")
+            return True
+
+    except KeyboardInterrupt:
+        # the listener has heard enough, which counts as having listened
+        _terminate(p)
+        print("stopped>")
+        return True
+
+    except BrokenPipeError:
+        pass
+
+    _terminate(p)
+    print("cancelled>")
+    return False
+
+
+def _terminate(p: Optional[subprocess.Popen]) -> None:
+    if p is not None:
+        p.terminate()
+        p.wait()
+
+
+def play_segment(segment: pydub.AudioSegment, **kwargs) -> bool:
+    "Play an already prepared segment."
+    return play(iter_chunks(segment), **kwargs)
+
+
+def iter_chunks(
+    segment: pydub.AudioSegment, chunk_s: float = CHUNK_S
+) -> Iterator[pydub.AudioSegment]:
+    "Split a segment into short chunks, so that it can be interrupted quickly."
+    step = int(chunk_s * MS_PER_S)
+    for start in range(0, max(len(segment), 1), step):
+        yield segment[start : start + step]
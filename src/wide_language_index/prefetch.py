@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+#
+#  prefetch.py
+#  wide-language-index
+#
+
+"""
+Prepare upcoming clips in the background during an annotation session, so
+that each one is ready to play the moment it's wanted.
+"""
+
+import collections
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+PREFETCH_DEPTH = 1
+
+
+class Prefetcher(object):
+    """
+    Wrap a sampler so that the next segments are chosen and their clips
+    prepared on a background thread, while the current one is annotated.
+
+    The sampler is only advanced while holding `lock`; hold it too when
+    saving annotations, so the sampler never sees a half-updated state.
+    Prepared clips are kept in memory until we move past their segment, so
+    replays are instant.
+    """
+
+    def __init__(
+        self,
+        sampler: Iterable,
+        prepare: Callable[[Any], Any],
+        depth: int = PREFETCH_DEPTH,
+    ):
+        self.sampler = iter(sampler)
+        self.prepare = prepare
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = collections.deque()
+        self.clips: Dict[tuple, Future] = {}
+        self.clips_lock = threading.Lock()
+
+    def __iter__(self) -> Iterator:
+        try:
+            self.fill()
+            while True:
+                # with no prefetching, the next segment is only chosen now
+                if not self.pending:
+                    self.pending.append(self.executor.submit(self._next))
+
+                try:
+                    segment = self.pending.popleft().result()
+                except StopIteration:
+                    return
+
+                self.fill()
+                yield segment
+                self.discard(segment)
+        finally:
+            self.close()
+
+    def fill(self) -> None:
+        # the current segment has been taken already, so only reserve depth
+        # more, since each reservation also counts against its language
+        while len(self.pending) < self.depth:
+            self.pending.append(self.executor.submit(self._next))
+
+    def _next(self):
+        with self.lock:
+            segment = next(self.sampler)
+
+        self.clip(segment)
+        return segment
+
+    def clip(self, segment) -> Any:
+        "Return the segment's prepared clip, preparing it here if need be."
+        key = segment_key(segment)
+        with self.clips_lock:
+            future = self.clips.get(key)
+            owner = future is None
+            if owner:
+                future = self.clips[key] = Future()
+
+        if owner:
+            try:
+                future.set_result(self.prepare(segment))
+            except Exception as e:
+                future.set_exception(e)
+
+        return future.result()
+
+    def ready(self, segment) -> Optional[Any]:
+        "Return the segment's prepared clip if it's ready, without waiting."
+        with self.clips_lock:
+            future = self.clips.get(segment_key(segment))
+
+        if future is None or not future.done() or future.exception():
+            return None
+
+        return future.result()
+
+    def discard(self, segment) -> None:
+        with self.clips_lock:
+            self.clips.pop(segment_key(segment), None)
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def segment_key(segment) -> tuple:
+    return (segment.sample["checksum"], segment.offset, segment.duration)
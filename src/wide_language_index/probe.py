@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+#  probe.py
+#  wide-language-index
+#
+
+"""
+Recognize audio we already have before downloading it. A file's probe
+fingerprint is its size plus a hash of its first and last few kilobytes,
+which a server can give us with a HEAD and two small range requests. We keep
+the fingerprints of every sample, and of every original we've downloaded,
+along with the ETags servers gave for them.
+"""
+
+import glob
+import hashlib
+import json
+import os
+from collections import namedtuple
+from os import path
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import requests
+
+PROBE_FILE = ".cache/probes.json"
+SAMPLE_PATTERN = "samples/*/*.mp3"
+
+PROBE_BYTES = 16 * 1024
+TIMEOUT_S = 20
+
+# what a server told us about a file without sending it; any part may be None
+Probe = namedtuple("Probe", "size etag fingerprint")
+
+
+class ProbeIndex(object):
+    """
+    Map probe fingerprints and ETags to the checksum of the sample they
+    belong to.
+    """
+
+    def __init__(self, fingerprints=None, etags=None, scanned=None):
+        self.fingerprints: Dict[str, str] = fingerprints or {}
+        self.etags: Dict[str, str] = etags or {}
+        # the mtime of each sample when it was last fingerprinted
+        self.scanned: Dict[str, float] = scanned or {}
+        self.sizes = {int(f.split(":")[0]) for f in self.fingerprints}
+
+    @classmethod
+    def load(cls) -> "ProbeIndex":
+        try:
+            with open(PROBE_FILE) as istream:
+                return cls(**json.load(istream))
+        except (OSError, ValueError, TypeError):
+            return cls()
+
+    def save(self) -> None:
+        os.makedirs(path.dirname(PROBE_FILE), exist_ok=True)
+        tmp_file = PROBE_FILE + ".tmp"
+        with open(tmp_file, "w") as ostream:
+            json.dump(
+                {
+                    "fingerprints": self.fingerprints,
+                    "etags": self.etags,
+                    "scanned": self.scanned,
+                },
+                ostream,
+                indent=2,
+                sort_keys=True,
+            )
+        os.replace(tmp_file, PROBE_FILE)
+
+    def update_from_samples(self) -> None:
+        "Fingerprint any samples that are new or changed since last time."
+        for filename in glob.glob(SAMPLE_PATTERN):
+            mtime = os.stat(filename).st_mtime
+            if self.scanned.get(filename) == mtime:
+                continue
+
+            checksum = path.splitext(path.basename(filename))[0].split("-")[-1]
+            self.add(file_fingerprint(filename), checksum)
+            self.scanned[filename] = mtime
+
+    def add(self, fingerprint: str, checksum: str, probe: Optional[Probe] = None):
+        self.fingerprints[fingerprint] = checksum
+        self.sizes.add(int(fingerprint.split(":")[0]))
+        if probe is not None and probe.etag is not None:
+            self.etags[probe.etag] = checksum
+
+    def find(self, probe: Probe) -> Optional[str]:
+        "The checksum of the sample matching the probe, if we have it."
+        if probe.etag is not None and probe.etag in self.etags:
+            return self.etags[probe.etag]
+
+        if probe.fingerprint is not None:
+            return self.fingerprints.get(probe.fingerprint)
+
+        return None
+
+
+def file_fingerprint(filename: str) -> str:
+    size = os.stat(filename).st_size
+    with open(filename, "rb") as istream:
+        head = istream.read(PROBE_BYTES)
+        istream.seek(max(size - PROBE_BYTES, 0))
+        tail = istream.read(PROBE_BYTES)
+
+    return _fingerprint(size, head, tail)
+
+
+def _fingerprint(size: int, head: bytes, tail: bytes) -> str:
+    return "{0}:{1}".format(size, hashlib.md5(head + tail).hexdigest())
+
+
+def probe_url(url: str, probes: ProbeIndex, user_agent: Optional[str] = None) -> Probe:
+    """
+    Ask the server about a file without downloading it. Its first and last
+    chunks are only fetched if a sample we have is exactly the same size.
+    """
+    headers = {"User-Agent": user_agent} if user_agent else {}
+    try:
+        resp = requests.head(
+            url, headers=headers, allow_redirects=True, timeout=TIMEOUT_S
+        )
+    except requests.RequestException:
+        return Probe(None, None, None)
+
+    if resp.status_code != 200:
+        return Probe(None, None, None)
+
+    etag = resp.headers.get("ETag")
+    etag_key = "{0} {1}".format(urlparse(resp.url).netloc, etag) if etag else None
+
+    try:
+        size = int(resp.headers["Content-Length"])
+    except (KeyError, ValueError):
+        return Probe(None, etag_key, None)
+
+    if size not in probes.sizes:
+        return Probe(size, etag_key, None)
+
+    head = _fetch_range(resp.url, "bytes=0-{0}".format(PROBE_BYTES - 1), headers)
+    tail = _fetch_range(resp.url, "bytes=-{0}".format(PROBE_BYTES), headers)
+    if head is None or tail is None:
+        return Probe(size, etag_key, None)
+
+    return Probe(size, etag_key, _fingerprint(size, head, tail))
+
+
+def _fetch_range(url: str, byte_range: str, headers: Dict[str, str]):
+    "Fetch part of a file, or None if the server won't send just that part."
+    # ask for the bytes as stored, so they hash the same as a file on disk
+    headers = {**headers, "Range": byte_range, "Accept-Encoding": "identity"}
+    try:
+        with requests.get(
+            url,
+            headers=headers,
+            stream=True,
+            timeout=TIMEOUT_S,
+        ) as resp:
+            if resp.status_code != 206:
+                # it's ignoring the range, so don't download the whole thing
+                return None
+
+            return resp.raw.read(PROBE_BYTES)
+
+    except requests.RequestException:
+        return None
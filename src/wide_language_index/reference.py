@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#
+#  reference.py
+#  wide-language-index
+#
+
+"""
+Reference data about languages: their names, which ISO 639-3 codes are
+valid, and which are macrolanguages. Nothing is loaded until it's first
+asked for, and the parsed data is cached on disk until its sources change.
+"""
+
+import csv
+import functools
+import json
+import os
+import pickle
+from os import path
+from typing import Any, Dict, FrozenSet
+
+NAME_INDEX_FILE = "ext/name_index_20140320.json"
+ISO_639_3_FILE = "ext/iso-639-3.tab"
+SOURCES = [NAME_INDEX_FILE, ISO_639_3_FILE]
+
+CACHE_FILE = ".cache/reference.pickle"
+
+# bump this whenever the parsed form changes
+REFERENCE_VERSION = 1
+
+
+def language_names() -> Dict[str, str]:
+    "Map each ISO 639-3 code to the language's printable name."
+    return _load()["names"]
+
+
+def valid_languages() -> FrozenSet[str]:
+    return _load()["valid"]
+
+
+def macro_languages() -> FrozenSet[str]:
+    return _load()["macro"]
+
+
+@functools.lru_cache(maxsize=None)
+def _load() -> Dict[str, Any]:
+    stamps = _source_stamps()
+
+    cached = _load_cache()
+    if (
+        cached is not None
+        and cached.get("version") == REFERENCE_VERSION
+        and cached.get("sources") == stamps
+    ):
+        return cached
+
+    ref = _parse()
+    ref["version"] = REFERENCE_VERSION
+    ref["sources"] = stamps
+    _save_cache(ref)
+
+    return ref
+
+
+def _parse() -> Dict[str, Any]:
+    with open(NAME_INDEX_FILE) as istream:
+        name_index = json.load(istream)
+
+    with open(ISO_639_3_FILE, newline="") as istream:
+        macro = frozenset(
+            r["Id"]
+            for r in csv.DictReader(istream, delimiter="\t")
+            if r["Scope"] == "M"
+        )
+
+    names = {r["id"]: r["print_name"] for r in name_index}
+    return {"names": names, "valid": frozenset(names), "macro": macro}
+
+
+def _source_stamps() -> Dict[str, int]:
+    return {f: os.stat(f).st_mtime_ns for f in SOURCES}
+
+
+def _load_cache():
+    try:
+        with open(CACHE_FILE, "rb") as istream:
+            return pickle.load(istream)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def _save_cache(ref: Dict[str, Any]) -> None:
+    os.makedirs(path.dirname(CACHE_FILE), exist_ok=True)
+
+    # write atomically, since several commands may start at once
+    tmp_file = "{0}.tmp{1}".format(CACHE_FILE, os.getpid())
+    with open(tmp_file, "wb") as ostream:
+        pickle.dump(ref, ostream, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, CACHE_FILE)
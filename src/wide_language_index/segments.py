@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+#  segments.py
+#  wide-language-index
+#
+
+"""
+Track which fixed-length segments of a sample are still unannotated.
+"""
+
+import math
+import random
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+
+class FreeSegments(object):
+    """
+    The unannotated segments of one sample, for one segment duration. A
+    bitmap marks which segments are free, and a dense array of free segment
+    ids, along with each id's position in it, lets us pick a free segment at
+    random or take one in O(1).
+    """
+
+    def __init__(self, n_segments: int, duration: float):
+        self.duration = duration
+        self.free = np.ones(n_segments, dtype=bool)
+        self.ids = np.arange(n_segments, dtype=np.int32)
+        self.pos = np.arange(n_segments, dtype=np.int32)
+        self.n_free = n_segments
+
+    @classmethod
+    def for_sample(
+        cls, sample: Dict[str, Any], duration: float, sample_len: float
+    ) -> "FreeSegments":
+        "Build the free segments of a sample, given its length in seconds."
+        segments = cls(int(sample_len // duration), duration)
+        for annotation in sample.get("annotations", ()):
+            segments.take_range(annotation["offset"], annotation["duration"])
+
+        return segments
+
+    def __len__(self) -> int:
+        return self.n_free
+
+    def is_free(self, segment_id: int) -> bool:
+        return bool(self.free[segment_id])
+
+    def offset(self, segment_id: int) -> float:
+        return segment_id * self.duration
+
+    def choose(self) -> Optional[int]:
+        "Pick a free segment at random, or None if there are none left."
+        if self.n_free == 0:
+            return None
+
+        return int(self.ids[random.randrange(self.n_free)])
+
+    def take(self, segment_id: int) -> None:
+        "Mark a segment as annotated, swapping it out of the free list."
+        if not self.free[segment_id]:
+            return
+
+        self.free[segment_id] = False
+
+        # move the last free id into this one's place
+        i = self.pos[segment_id]
+        last = self.ids[self.n_free - 1]
+        self.ids[i] = last
+        self.pos[last] = i
+        self.ids[self.n_free - 1] = segment_id
+        self.pos[segment_id] = self.n_free - 1
+        self.n_free -= 1
+
+    def take_range(self, offset: float, duration: float) -> None:
+        """
+        Mark every segment overlapping the given span as annotated, so that
+        annotations needn't line up with our grid or share our duration.
+        """
+        start = max(0, int(offset // self.duration))
+        end = min(len(self.free), int(math.ceil((offset + duration) / self.duration)))
+        for segment_id in range(start, end):
+            self.take(segment_id)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+#  timing.py
+#  wide-language-index
+#
+
+"""
+Lightweight per-stage timing, for finding out where a long run spends its
+time.
+"""
+
+import contextlib
+import json
+import time
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List
+
+import numpy as np
+
+PERCENTILES = [50, 90, 99]
+
+
+class StageTimer(object):
+    "Accumulate wall-clock time spent in each named stage."
+
+    def __init__(self):
+        self.stages = defaultdict(float)
+
+    @contextlib.contextmanager
+    def __call__(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage] += time.perf_counter() - start
+
+    def as_dict(self) -> Dict[str, float]:
+        return {stage: round(t, 6) for stage, t in self.stages.items()}
+
+
+def summarize(records: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    """
+    Summarize the "stages" of many timing records into totals and
+    percentiles per stage.
+    """
+    by_stage: Dict[str, List[float]] = defaultdict(list)
+    for r in records:
+        for stage, t in r["stages"].items():
+            by_stage[stage].append(t)
+
+    summary = {}
+    for stage, ts in by_stage.items():
+        a = np.array(ts)
+        summary[stage] = {
+            "n": len(ts),
+            "total": round(float(a.sum()), 3),
+            **{
+                "p{0}".format(p): round(float(np.percentile(a, p)), 4)
+                for p in PERCENTILES
+            },
+            "max": round(float(a.max()), 4),
+        }
+
+    return summary
+
+
+def print_summary(summary: Dict[str, Dict[str, float]]) -> None:
+    columns = ["total"] + ["p{0}".format(p) for p in PERCENTILES] + ["max"]
+    print(
+        "{:>12s} {:>6s} ".format("stage", "n") + " ".join(f"{c:>9s}" for c in columns)
+    )
+    for stage, s in sorted(summary.items(), key=lambda kv: -kv[1]["total"]):
+        print(
+            "{:>12s} {:>6d} ".format(stage, s["n"])
+            + " ".join("{:>9.3f}".format(s[c]) for c in columns)
+        )
+
+
+def write_jsonl(records: Iterable[Dict[str, Any]], filename: str) -> None:
+    "Append records to a JSON lines file."
+    with open(filename, "a") as ostream:
+        for r in records:
+            ostream.write(json.dumps(r, sort_keys=True) + "\n")
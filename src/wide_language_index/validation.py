@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+#
+#  validation.py
+#  wide-language-index
+#
+
+"""
+Validate index records against the sample and annotation schemas. The
+schemas are loaded once, their references inlined, and compiled into a plain
+Python check that costs a few microseconds per record. jsonschema itself is
+only consulted to explain why a record failed.
+"""
+
+import functools
+import json
+import re
+from os import path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+SCHEMA_DIR = "index"
+SAMPLE_SCHEMA = "sample.schema.json"
+
+# keywords that only describe a schema, and don't constrain anything
+ANNOTATION_KEYWORDS = {"$schema", "title", "description", "default"}
+
+Record = Dict[str, Any]
+Check = Callable[[Any], bool]
+
+
+def validate_sample(record: Record) -> None:
+    "Raise jsonschema.ValidationError if the record is invalid."
+    if not sample_check()(record):
+        sample_validator().validate(record)
+
+
+def sample_errors(record: Record) -> List[str]:
+    "Describe everything wrong with the record, if anything."
+    if sample_check()(record):
+        return []
+
+    return [_describe(e) for e in sample_validator().iter_errors(record)]
+
+
+def validate_many(records: Iterable[Record]) -> Iterator[Tuple[int, List[str]]]:
+    "Yield the (position, errors) of each invalid record."
+    check = sample_check()
+    for i, record in enumerate(records):
+        if not check(record):
+            yield i, [_describe(e) for e in sample_validator().iter_errors(record)]
+
+
+@functools.lru_cache(maxsize=None)
+def sample_check() -> Check:
+    schema = load_schema(SAMPLE_SCHEMA)
+    try:
+        return compile_schema(schema)
+    except NotImplementedError:
+        # a keyword we can't compile, so fall back to the general validator
+        return sample_validator().is_valid
+
+
+@functools.lru_cache(maxsize=None)
+def sample_validator():
+    import jsonschema  # slow to import, so only load it when needed
+
+    return jsonschema.Draft4Validator(load_schema(SAMPLE_SCHEMA))
+
+
+def load_schema(name: str) -> Dict[str, Any]:
+    "Load a schema, inlining any references to the other schemas beside it."
+    with open(path.join(SCHEMA_DIR, name)) as istream:
+        return _inline_refs(json.load(istream))
+
+
+def _inline_refs(node: Any) -> Any:
+    if isinstance(node, dict):
+        ref = node.get("$ref")
+        if isinstance(ref, str) and ref.endswith(".schema.json"):
+            return load_schema(ref)
+
+        return {k: _inline_refs(v) for k, v in node.items()}
+
+    if isinstance(node, list):
+        return [_inline_refs(v) for v in node]
+
+    return node
+
+
+def compile_schema(schema: Any) -> Check:
+    """
+    Compile the subset of draft 4 that our schemas use into a single check.
+    Raise NotImplementedError for anything outside that subset.
+    """
+    if not isinstance(schema, dict):
+        # not a schema, so it constrains nothing
+        return _always
+
+    checks = []
+    for keyword, value in schema.items():
+        if keyword in ANNOTATION_KEYWORDS:
+            continue
+
+        if keyword not in _COMPILERS:
+            raise NotImplementedError(keyword)
+
+        checks.append(_COMPILERS[keyword](value))
+
+    if not checks:
+        return _always
+
+    if len(checks) == 1:
+        return checks[0]
+
+    return lambda x: all(c(x) for c in checks)
+
+
+def _always(x: Any) -> bool:
+    return True
+
+
+_TYPES = {
+    "object": lambda x: isinstance(x, dict),
+    "array": lambda x: isinstance(x, list),
+    "string": lambda x: isinstance(x, str),
+    "number": lambda x: isinstance(x, (int, float)) and not isinstance(x, bool),
+    "integer": lambda x: isinstance(x, int) and not isinstance(x, bool),
+    "boolean": lambda x: isinstance(x, bool),
+    "null": lambda x: x is None,
+}
+
+
+def _compile_type(value) -> Check:
+    names = [value] if isinstance(value, str) else value
+    tests = [_TYPES[n] for n in names]
+    if len(tests) == 1:
+        return tests[0]
+
+    return lambda x: any(t(x) for t in tests)
+
+
+def _compile_properties(value) -> Check:
+    props = [(k, compile_schema(v)) for k, v in value.items()]
+
+    def check(x):
+        if not isinstance(x, dict):
+            return True
+
+        for k, c in props:
+            if k in x and not c(x[k]):
+                return False
+
+        return True
+
+    return check
+
+
+def _compile_required(value) -> Check:
+    keys = list(value)
+    return lambda x: not isinstance(x, dict) or all(k in x for k in keys)
+
+
+def _compile_items(value) -> Check:
+    if not isinstance(value, dict):
+        raise NotImplementedError("items as a list")
+
+    item = compile_schema(value)
+    return lambda x: not isinstance(x, list) or all(item(v) for v in x)
+
+
+def _compile_min_items(value) -> Check:
+    return lambda x: not isinstance(x, list) or len(x) >= value
+
+
+def _compile_unique_items(value) -> Check:
+    if not value:
+        return _always
+
+    def check(x):
+        if not isinstance(x, list):
+            return True
+
+        seen = [json.dumps(v, sort_keys=True) for v in x]
+        return len(set(seen)) == len(seen)
+
+    return check
+
+
+def _compile_enum(value) -> Check:
+    options = list(value)
+    # bools equal ints in Python, but not in JSON
+    return lambda x: any(x == o and type(x) is type(o) for o in options)
+
+
+def _compile_pattern(value) -> Check:
+    search = re.compile(value).search
+    return lambda x: not isinstance(x, str) or search(x) is not None
+
+
+def _compile_one_of(value) -> Check:
+    subs = [compile_schema(s) for s in value]
+    return lambda x: sum(1 for s in subs if s(x)) == 1
+
+
+def _compile_any_of(value) -> Check:
+    subs = [compile_schema(s) for s in value]
+    return lambda x: any(s(x) for s in subs)
+
+
+def _compile_all_of(value) -> Check:
+    subs = [compile_schema(s) for s in value]
+    return lambda x: all(s(x) for s in subs)
+
+
+_COMPILERS = {
+    "type": _compile_type,
+    "properties": _compile_properties,
+    "required": _compile_required,
+    "items": _compile_items,
+    "minItems": _compile_min_items,
+    "uniqueItems": _compile_unique_items,
+    "enum": _compile_enum,
+    "pattern": _compile_pattern,
+    "oneOf": _compile_one_of,
+    "anyOf": _compile_any_of,
+    "allOf": _compile_all_of,
+}
+
+
+def _describe(error) -> str:
+    where = "/".join(str(p) for p in error.absolute_path)
+    return "{0}: {1}".format(where or "<record>", error.message)
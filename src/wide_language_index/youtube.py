@@ -5,8 +5,6 @@ import tempfile
 import urllib.parse
 from datetime import datetime
 
-import yt_dlp
-
 from .audio import AudioSample
 
 
@@ -63,6 +61,8 @@ def download_youtube_sample(url: str) -> AudioSample:
         "no_warnings": True,
     }
 
+    import yt_dlp  # slow to import, so only load it when needed
+
     try:
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
             ydl.download([url])
@@ -84,6 +84,8 @@ def fetch_youtube_metadata(url: str) -> dict[str, str]:
         "no_warnings": True,
     }
 
+    import yt_dlp  # slow to import, so only load it when needed
+
     try:
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
             info = ydl.extract_info(url, download=False)